@@ -7,9 +7,15 @@ Uses query understanding, multi-step retrieval, and result synthesis
 import os
 import json
 import time
-from typing import List, Dict, Any
-from pinecone import Pinecone
-from openai import OpenAI
+import asyncio
+import hashlib
+import heapq
+from array import array
+from collections import OrderedDict
+from typing import List, Dict, Any, Callable, Optional
+import tiktoken
+from pinecone.grpc import PineconeGRPC as Pinecone
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -23,53 +29,99 @@ if not PINECONE_API_KEY or not OPENAI_API_KEY:
     print("❌ Error: Please set PINECONE_API_KEY and OPENAI_API_KEY environment variables")
     exit(1)
 
-class AdvancedRAGSystem:
-    def __init__(self):
-        self.pc = Pinecone(api_key=PINECONE_API_KEY)
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
-        self.index_name = "professorjames-experiment-higheraccuracy"
-        
-    def understand_query(self, query: str) -> Dict[str, Any]:
-        """Understand the query and extract key information"""
-        try:
-            prompt = f"""
-You are an expert at analyzing educational queries. Analyze this query and extract key information:
+# Tokenizer used to budget prompt context for gpt-4o
+TOKENIZER = tiktoken.encoding_for_model("gpt-4o")
+SOURCE_TOKEN_BUDGET = 300  # Max tokens of each search result sent to synthesis
 
-QUERY: "{query}"
+# Static instructions go first (in the system message) so the prompt prefix is identical
+# across requests and eligible for OpenAI's automatic prompt caching.
+QUERY_ANALYSIS_SYSTEM_PROMPT = """You are an expert at analyzing educational queries. Analyze the user's query and extract key information.
 
 Please provide a detailed analysis in JSON format:
-{{
+{
     "query_type": "definition/explanation/comparison/how_to/example",
     "main_topic": "the primary subject",
     "subtopics": ["related concepts"],
     "required_depth": "basic/intermediate/advanced",
     "expected_answer_type": "definition/explanation/step_by_step/comparison",
     "key_terms": ["important terms to search for"],
-    "context_needed": ["what background information is needed"]
-}}
+    "context_needed": ["what background information is needed"],
+    "search_queries": ["3-5 concrete search queries for retrieving textbook passages that answer the query"]
+}
 
-Focus on understanding what the user is really asking for.
-"""
+Focus on understanding what the user is really asking for."""
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
+SYNTHESIS_SYSTEM_PROMPT = """You are an expert educator who synthesizes information from multiple sources to provide comprehensive answers.
+
+Synthesize a comprehensive, well-structured answer to the user's question using the provided sources. The answer should:
+1. Directly address the user's question
+2. Use information from the sources provided
+3. Be organized and easy to understand
+4. Include relevant examples or explanations
+5. Acknowledge any limitations in the available information
+
+Return your answer in JSON format:
+{
+    "answer": "your comprehensive answer here",
+    "confidence": "high/medium/low",
+    "sources_used": number_of_sources_used,
+    "key_points": ["point1", "point2", "point3"],
+    "limitations": ["any limitations of the answer"]
+}"""
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Collapse whitespace and cut text to at most max_tokens tokens"""
+    text = ' '.join(text.split())
+    # Byte-level BPE tokens each cover at least one UTF-8 byte (but a single character
+    # can take several tokens), so only text this short in bytes can't be over budget
+    if len(text.encode('utf-8')) <= max_tokens:
+        return text
+    # encode_ordinary skips the special-token scan encode() does on every call
+    tokens = TOKENIZER.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return TOKENIZER.decode(tokens[:max_tokens])
+
+def word_shingles(text: str, size: int = 3) -> set:
+    """Return the set of word n-grams in already-normalized text"""
+    words = text.split()
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def jaccard_similarity(a: set, b: set) -> float:
+    """Jaccard similarity of two shingle sets"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class AdvancedRAGSystem:
+    def __init__(self):
+        self.pc = Pinecone(api_key=PINECONE_API_KEY)
+        self.openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5)  # Backs off on 429/5xx
+        self.index_name = "professorjames-experiment-higheraccuracy"
+        self.embedding_cache_size = 4096
+        self._embedding_cache = OrderedDict()  # blake2b(text) -> float32 array('f') embedding, in LRU order
+        self.match_cache_size = 1024
+        self._match_cache = OrderedDict()  # (namespace, normalized query) -> Pinecone matches, in LRU order
+        
+    async def understand_query(self, query: str) -> Dict[str, Any]:
+        """Understand the query and extract key information"""
+        try:
+            response = await self.openai_client.chat.completions.create(
+                model="gpt-4o-mini",  # Classification-style task; gpt-4o is kept for synthesis
                 messages=[
-                    {"role": "system", "content": "You are an expert at analyzing educational queries."},
-                    {"role": "user", "content": prompt}
+                    {"role": "system", "content": QUERY_ANALYSIS_SYSTEM_PROMPT},
+                    {"role": "user", "content": f'QUERY: "{query}"'}
                 ],
-                temperature=0.2,
-                max_tokens=500
+                temperature=0,
+                max_tokens=300,
+                response_format={"type": "json_object"}
             )
             
             content = response.choices[0].message.content
             try:
-                if '{' in content and '}' in content:
-                    start = content.find('{')
-                    end = content.rfind('}') + 1
-                    json_str = content[start:end]
-                    return json.loads(json_str)
-                else:
-                    return {"error": "No valid JSON found in response"}
+                return json.loads(content)
             except json.JSONDecodeError as e:
                 return {"error": f"JSON parsing failed: {e}"}
                 
@@ -79,6 +131,11 @@ Focus on understanding what the user is really asking for.
     def generate_search_queries(self, query_analysis: Dict[str, Any]) -> List[str]:
         """Generate multiple search queries based on query analysis"""
         try:
+            # Prefer the queries produced alongside the analysis, saving a separate step
+            llm_queries = [q for q in query_analysis.get('search_queries', []) if isinstance(q, str) and q.strip()]
+            if llm_queries:
+                return llm_queries[:5]
+            
             main_topic = query_analysis.get('main_topic', '')
             key_terms = query_analysis.get('key_terms', [])
             query_type = query_analysis.get('query_type', '')
@@ -107,66 +164,156 @@ Focus on understanding what the user is really asking for.
             print(f"Failed to generate search queries: {e}")
             return [query_analysis.get('main_topic', '')]
     
-    def generate_embedding(self, text: str) -> List[float]:
+    async def generate_embedding(self, text: str) -> List[float]:
         """Generate embedding using OpenAI"""
+        return (await self.generate_embeddings_batch([text]))[0]
+    
+    async def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        """Embed one batch of texts, returning None for each text on failure"""
         try:
-            response = self.openai_client.embeddings.create(
+            response = await self.openai_client.embeddings.create(
                 model="text-embedding-3-large",
-                input=text,
+                input=batch,
                 encoding_format="float"
             )
-            return response.data[0].embedding
+            return [d.embedding for d in response.data]
         except Exception as e:
-            print(f"Failed to generate embedding: {e}")
-            return None
+            print(f"Failed to generate embeddings: {e}")
+            return [None] * len(batch)
     
-    def search_multiple_queries(self, search_queries: List[str], namespace: str = "improved_textbook") -> List[Dict[str, Any]]:
-        """Search using multiple queries and combine results"""
-        all_results = []
+    async def generate_embeddings_batch(self, texts: List[str], batch_size: int = 96) -> List[List[float]]:
+        """Generate embeddings for many texts with one OpenAI request per batch"""
+        keys = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in texts]
         
+        # Only send texts that are neither cached nor repeated earlier in this call
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self._embedding_cache and key not in missing:
+                missing[key] = text
+        
+        fresh = {}
+        if missing:
+            missing_texts = list(missing.values())
+            batches = [missing_texts[i:i + batch_size] for i in range(0, len(missing_texts), batch_size)]
+            results = await asyncio.gather(*(self._embed_batch(batch) for batch in batches))
+            fresh = dict(zip(missing, (embedding for batch in results for embedding in batch)))
+            for key, embedding in fresh.items():
+                if embedding is not None:
+                    # 3072 packed float32s take 12 KB; the list of Python floats takes ~100 KB
+                    self._embedding_cache[key] = array('f', embedding)
+            while len(self._embedding_cache) > self.embedding_cache_size:
+                self._embedding_cache.popitem(last=False)
+        
+        embeddings = []
+        for key in keys:
+            if key in fresh:
+                embeddings.append(fresh[key])
+            elif key in self._embedding_cache:
+                self._embedding_cache.move_to_end(key)
+                embeddings.append(self._embedding_cache[key].tolist())
+            else:
+                embeddings.append(None)
+        return embeddings
+    
+    async def search_multiple_queries(self, search_queries: List[str], namespace: str = "improved_textbook") -> List[Dict[str, Any]]:
+        """Search using multiple queries and combine results"""
         try:
             index = self.pc.Index(self.index_name)
+            # Each distinct query string costs one Pinecone round-trip, so drop repeats up front
+            search_queries = list(dict.fromkeys(search_queries))
             
-            for query in search_queries:
-                embedding = self.generate_embedding(query)
-                if not embedding:
-                    continue
-                
-                results = index.query(
+            # Hot queries are answered from the local match cache without embedding or Pinecone
+            cache_keys = [(namespace, ' '.join(query.lower().replace('"', ' ').split())) for query in search_queries]
+            matches_by_key = {}
+            for key in cache_keys:
+                if key in self._match_cache:
+                    self._match_cache.move_to_end(key)
+                    matches_by_key[key] = self._match_cache[key]
+            
+            uncached = [(query, key) for query, key in zip(search_queries, cache_keys) if key not in matches_by_key]
+            embeddings = await self.generate_embeddings_batch([query for query, _ in uncached])
+            searches = [(key, embedding) for (_, key), embedding in zip(uncached, embeddings) if embedding]
+            
+            # Run the Pinecone queries concurrently rather than one round-trip at a time
+            responses = await asyncio.gather(*(
+                asyncio.to_thread(
+                    index.query,
                     vector=embedding,
                     namespace=namespace,
                     top_k=5,
                     include_metadata=True
                 )
-                
-                for match in results.matches:
+                for _, embedding in searches
+            ))
+            
+            for (key, _), results in zip(searches, responses):
+                matches_by_key[key] = results.matches
+                self._match_cache[key] = results.matches
+            while len(self._match_cache) > self.match_cache_size:
+                self._match_cache.popitem(last=False)
+            
+            # Candidates are held as parallel lists indexed by position; result dicts are
+            # only built for the few hits that survive ranking and deduplication
+            candidate_matches = []
+            candidate_query_indices = []
+            heap = []
+            for query_index, key in enumerate(cache_keys):
+                for match in matches_by_key.get(key, []):
                     if match.score > 0.3:
-                        all_results.append({
-                            'score': match.score,
-                            'text': match.metadata.get('text', ''),
-                            'metadata': match.metadata,
-                            'query': query
-                        })
+                        heap.append((-match.score, len(candidate_matches)))
+                        candidate_matches.append(match)
+                        candidate_query_indices.append(query_index)
             
             # Remove duplicates and sort by score
             unique_results = []
-            seen_texts = set()
+            seen_digests = set()
+            kept_shingles = []
+            
+            # Pop candidates best-first from a heap so only the consumed prefix is ordered
+            heapq.heapify(heap)
             
-            for result in sorted(all_results, key=lambda x: x['score'], reverse=True):
-                # Simple deduplication based on text similarity
-                text_key = result['text'][:100]  # First 100 chars as key
-                if text_key not in seen_texts:
-                    unique_results.append(result)
-                    seen_texts.add(text_key)
+            while heap:
+                i = heapq.heappop(heap)[1]
+                match = candidate_matches[i]
+                text = match.metadata.get('text', '')
+                
+                # Exact duplicates (ignoring case and whitespace) are caught by hash first
+                normalized = ' '.join(text.lower().split())
+                digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+                if digest in seen_digests:
+                    continue
+                
+                # Near-duplicates are caught by word 3-shingle overlap with kept results
+                shingles = word_shingles(normalized)
+                if any(jaccard_similarity(shingles, kept) >= 0.85 for kept in kept_shingles):
+                    continue
+                
+                seen_digests.add(digest)
+                kept_shingles.append(shingles)
+                query_index = candidate_query_indices[i]
+                unique_results.append({
+                    'score': match.score,
+                    'text': text,
+                    'metadata': match.metadata,
+                    'query': search_queries[query_index],
+                    'query_index': query_index
+                })
+                if len(unique_results) == 10:  # Return top 10 unique results
+                    break
             
-            return unique_results[:10]  # Return top 10 unique results
+            return unique_results
             
         except Exception as e:
             print(f"Search failed: {e}")
             return []
     
-    def synthesize_answer(self, query: str, query_analysis: Dict[str, Any], search_results: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Synthesize a comprehensive answer from search results"""
+    async def synthesize_answer(self, query: str, query_analysis: Dict[str, Any], search_results: List[Dict[str, Any]],
+                          on_delta: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """Synthesize a comprehensive answer from search results
+        
+        If on_delta is given, the completion is streamed and each text fragment is
+        passed to it as soon as it arrives; the parsed JSON is still returned at the end.
+        """
         try:
             if not search_results:
                 return {
@@ -178,14 +325,12 @@ Focus on understanding what the user is really asking for.
             # Prepare context from search results
             context_parts = []
             for i, result in enumerate(search_results[:5]):  # Use top 5 results
-                context_parts.append(f"Source {i+1} (Score: {result['score']:.3f}): {result['text'][:800]}")
+                text = truncate_to_tokens(result['text'], SOURCE_TOKEN_BUDGET)
+                context_parts.append(f"Source {i+1} (Score: {result['score']:.3f}): {text}")
             
             context = "\n\n".join(context_parts)
             
-            prompt = f"""
-You are an expert educator. Synthesize a comprehensive answer to the user's question using the provided sources.
-
-USER QUESTION: "{query}"
+            prompt = f"""USER QUESTION: "{query}"
 
 QUERY ANALYSIS:
 - Type: {query_analysis.get('query_type', 'unknown')}
@@ -195,57 +340,46 @@ QUERY ANALYSIS:
 
 SOURCES:
 {context}
-
-Please provide a comprehensive, well-structured answer that:
-1. Directly addresses the user's question
-2. Uses information from the sources provided
-3. Is organized and easy to understand
-4. Includes relevant examples or explanations
-5. Acknowledges any limitations in the available information
-
-Return your answer in JSON format:
-{{
-    "answer": "your comprehensive answer here",
-    "confidence": "high/medium/low",
-    "sources_used": number_of_sources_used,
-    "key_points": ["point1", "point2", "point3"],
-    "limitations": ["any limitations of the answer"]
-}}
 """
 
-            response = self.openai_client.chat.completions.create(
+            response = await self.openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
-                    {"role": "system", "content": "You are an expert educator who synthesizes information from multiple sources to provide comprehensive answers."},
+                    {"role": "system", "content": SYNTHESIS_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
-                temperature=0.3,
-                max_tokens=1500
+                temperature=0,
+                max_tokens=1500,
+                response_format={"type": "json_object"},
+                stream=on_delta is not None
             )
             
-            content = response.choices[0].message.content
+            if on_delta is not None:
+                fragments = []
+                async for chunk in response:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        fragments.append(delta)
+                        on_delta(delta)
+                content = "".join(fragments)
+            else:
+                content = response.choices[0].message.content
             try:
-                if '{' in content and '}' in content:
-                    start = content.find('{')
-                    end = content.rfind('}') + 1
-                    json_str = content[start:end]
-                    return json.loads(json_str)
-                else:
-                    return {"error": "No valid JSON found in response", "raw_response": content}
+                return json.loads(content)
             except json.JSONDecodeError as e:
                 return {"error": f"JSON parsing failed: {e}", "raw_response": content}
                 
         except Exception as e:
             return {"error": f"Synthesis failed: {e}"}
     
-    def advanced_search(self, query: str) -> Dict[str, Any]:
+    async def advanced_search(self, query: str, on_delta: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
         """Perform advanced RAG search with query understanding and synthesis"""
         
         print(f"🔍 Advanced RAG Search: '{query}'")
         
         # Step 1: Understand the query
         print("📝 Understanding query...")
-        query_analysis = self.understand_query(query)
+        query_analysis = await self.understand_query(query)
         
         if 'error' in query_analysis:
             return {"error": f"Query understanding failed: {query_analysis['error']}"}
@@ -260,12 +394,12 @@ Return your answer in JSON format:
         
         # Step 3: Search with multiple queries
         print("🔎 Searching with multiple queries...")
-        search_results = self.search_multiple_queries(search_queries)
+        search_results = await self.search_multiple_queries(search_queries)
         print(f"✅ Found {len(search_results)} relevant results")
         
         # Step 4: Synthesize answer
         print("🧠 Synthesizing comprehensive answer...")
-        synthesis = self.synthesize_answer(query, query_analysis, search_results)
+        synthesis = await self.synthesize_answer(query, query_analysis, search_results, on_delta=on_delta)
         
         if 'error' in synthesis:
             return {"error": f"Answer synthesis failed: {synthesis['error']}"}
@@ -280,7 +414,7 @@ Return your answer in JSON format:
             "best_score": search_results[0]['score'] if search_results else 0
         }
 
-def test_advanced_rag():
+async def test_advanced_rag():
     """Test the advanced RAG system"""
     
     rag_system = AdvancedRAGSystem()
@@ -295,11 +429,18 @@ def test_advanced_rag():
     print("🧪 Testing Advanced RAG System")
     print("="*50)
     
-    for query in test_queries:
+    # Run the test queries concurrently, bounded to stay within OpenAI rate limits
+    semaphore = asyncio.Semaphore(10)
+    
+    async def run_query(query: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await rag_system.advanced_search(query)
+    
+    results = await asyncio.gather(*(run_query(query) for query in test_queries))
+    
+    for query, result in zip(test_queries, results):
         print(f"\n🔍 Testing: '{query}'")
         
-        result = rag_system.advanced_search(query)
-        
         if 'error' in result:
             print(f"❌ Error: {result['error']}")
         else:
@@ -311,4 +452,4 @@ def test_advanced_rag():
         print("-" * 30)
 
 if __name__ == "__main__":
-    test_advanced_rag() 
\ No newline at end of file
+    asyncio.run(test_advanced_rag()) 
\ No newline at end of file
@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for self-hosting the grading UI
+Run with: gunicorn rag_grading_ui:app
+"""
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5002')
+
+# Requests mostly wait on Pinecone/OpenAI, so threads carry the concurrency. Each worker
+# process keeps its own caches and upstream connection pools, so keep the worker count low.
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# Hold idle client connections open (longer than typical load balancer idle timeouts)
+keepalive = 75
+
+# Streamed grades can take a while when a tiered grade escalates to the full model
+timeout = 120
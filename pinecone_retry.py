@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Pinecone Retry Helpers
+Shared retry policy for the upload scripts and the grading app
+"""
+
+from pinecone.exceptions import PineconeApiException
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+def is_retryable_pinecone_error(error: BaseException) -> bool:
+    """Retry on Pinecone rate limits and transient server errors only"""
+    return isinstance(error, PineconeApiException) and (error.status == 429 or (error.status or 0) >= 500)
+
+@retry(
+    wait=wait_random_exponential(multiplier=1, max=20),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_retryable_pinecone_error),
+    reraise=True
+)
+def upsert_records_with_retry(index, namespace: str, records: list):
+    """Upsert records, backing off only when Pinecone pushes back"""
+    index.upsert_records(namespace=namespace, records=records)
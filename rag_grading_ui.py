@@ -5,10 +5,28 @@ Simple web interface for testing the RAG grading system
 """
 
 import os
-import json
-from flask import Flask, render_template_string, request, jsonify
+import gzip
+import time
+import asyncio
+import hashlib
+import threading
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import httpx
+import orjson
+import tiktoken
 from pinecone import Pinecone
-from openai import OpenAI
+from pinecone_retry import is_retryable_pinecone_error
+from sse import stream_deltas
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -18,8 +36,194 @@ load_dotenv()
 PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses and parse request bodies with orjson"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Log records are handed to a background thread for writing, so a request never blocks
+# on stdout (which serverless platforms drain synchronously into their log pipeline)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records on shutdown
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+MIN_QUESTION_CHARS = 10  # Shorter questions can't retrieve meaningful textbook context
+MIN_ANSWER_CHARS = 5  # Shorter answers get an F without a search or a completion
+MAX_INPUT_CHARS = 10000  # Per field; keeps a pasted essay from blowing up the prompt
+SOURCE_TOKEN_LIMIT = 250  # Max tokens of each textbook hit that reach the grading prompt
+SOURCE_TOKEN_BUDGET = 1500  # Max tokens of textbook context per grading prompt
+RUBRIC_CHAR_LIMIT = 1000  # Max chars of each rubric chunk that reach the grading prompt
+SOURCE_OVERLAP_LIMIT = 0.3  # Skip a hit if this share of its 5-token shingles is already in the prompt
+TOKENIZER = tiktoken.encoding_for_model("gpt-4o")  # Same encoding as gpt-4o-mini
+
+# Grading models: "tiered" grades with the fast model and escalates low-confidence or
+# unparseable grades to the full one; "fast" and "full" use a single model
+FAST_GRADING_MODEL = "gpt-4o-mini"
+FULL_GRADING_MODEL = "gpt-4o"
+GRADING_MODEL_TIER = os.environ.get('GRADING_MODEL_TIER', 'tiered')
+
+# Static grading instructions go first (in the system message) so the prompt prefix is
+# identical across requests and eligible for OpenAI's automatic prompt caching.
+GRADING_SYSTEM_PROMPT = """You are an expert educator who grades student answers using both textbook content and grading rubrics.
+
+You are grading a student's answer to a business ethics question. Use the provided textbook sources and rubric criteria to evaluate the student's response.
+
+Please grade this answer based on:
+1. **Accuracy of content** - does it match the textbook material?
+2. **Completeness of response** - does it cover key points from the rubric?
+3. **Clarity and organization** - is the answer well-structured?
+4. **Use of relevant examples or concepts** - does it demonstrate understanding?
+5. **Adherence to grading criteria** - does it meet the rubric standards?
+
+Return your evaluation in JSON format:
+{
+    "grade": "A/B/C/D/F",
+    "score": 85,
+    "feedback": "Detailed feedback explaining the grade",
+    "strengths": ["strength 1", "strength 2"],
+    "weaknesses": ["weakness 1", "weakness 2"],
+    "key_points_missing": ["missing point 1", "missing point 2"],
+    "key_points_correct": ["correct point 1", "correct point 2"],
+    "confidence": "high/medium/low",
+    "suggestions": ["suggestion 1", "suggestion 2"],
+    "rubric_applied": "Brief note on which rubric criteria were used"
+}
+
+Be fair but rigorous. A grade of A should be for excellent answers, B for good, C for satisfactory, D for poor, and F for failing."""
+GRADING_SYSTEM_PROMPT_TOKENS = len(TOKENIZER.encode_ordinary(GRADING_SYSTEM_PROMPT))  # Counted once at import
+
+# OpenAI only caches prompt prefixes of at least this many tokens. Every grading prompt
+# starts with the system prompt and then the rubric, so that is the prefix that gets reused.
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Structured Outputs schema for the grade object: the model can only emit these fields,
+# with valid grade letters and confidence levels. Properties keep the order above so
+# grade and score stream first.
+STRING_LIST = {"type": "array", "items": {"type": "string"}}
+GRADE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "grade",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "grade": {"type": "string", "enum": ["A", "B", "C", "D", "F"]},
+                "score": {"type": "integer"},
+                "feedback": {"type": "string"},
+                "strengths": STRING_LIST,
+                "weaknesses": STRING_LIST,
+                "key_points_missing": STRING_LIST,
+                "key_points_correct": STRING_LIST,
+                "confidence": {"type": "string", "enum": ["high", "medium", "low"]},
+                "suggestions": STRING_LIST,
+                "rubric_applied": {"type": "string"}
+            },
+            "required": [
+                "grade", "score", "feedback", "strengths", "weaknesses", "key_points_missing",
+                "key_points_correct", "confidence", "suggestions", "rubric_applied"
+            ],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Per-request part of the prompt; the rubric is the same for every request and the sources
+# for every answer to the same question, so they go ahead of the student answer
+GRADING_PROMPT_TEMPLATE = """RUBRIC CRITERIA:
+{rubric_context}
+
+QUESTION: "{question}"
+
+TEXTBOOK SOURCES:
+{context}
+
+STUDENT ANSWER: "{student_answer}"
+"""
+
+# Shared worker pool for background work (cache warming, streamed grades); created once
+# so requests don't pay thread start-up
+io_executor = ThreadPoolExecutor(max_workers=16)
+
+# Grading runs on one long-lived event loop in a background thread. Flask stays a plain
+# WSGI app (as Vercel expects) and request threads just wait on the result, while all
+# in-flight completions share the async client's connection pool on that loop.
+event_loop = asyncio.new_event_loop()
+# Blocking Pinecone calls reach the loop via asyncio.to_thread; give them a pool sized for
+# the overlap we want instead of the CPU-derived default (min(32, cpus + 4))
+PINECONE_IO_THREADS = int(os.environ.get('PINECONE_IO_THREADS', 16))
+event_loop.set_default_executor(ThreadPoolExecutor(max_workers=PINECONE_IO_THREADS, thread_name_prefix="pinecone-io"))
+threading.Thread(target=event_loop.run_forever, name="openai-event-loop", daemon=True).start()
+
+# Caps grading completions in flight per process, so /grade_batch fan-out stays under the
+# OpenAI rate limit instead of triggering a storm of 429 retries
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8))
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)  # Only used on event_loop
+
+def run_async(coro):
+    """Run a coroutine on the background event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
+class Hit(NamedTuple):
+    """One textbook search hit; immutable, so cached hits are shared without copying"""
+    score: float
+    text: str
+    doc_id: str
+
+def select_sources(results: list) -> list:
+    """Trim search hits to the prompt's token budget, best first, dropping near-duplicates
+    
+    Overlapping chunks are common (neighbouring pages, repeated definitions) and only cost
+    prompt tokens, so a hit is skipped when most of its 5-token shingles were already kept.
+    """
+    selected = []
+    seen_shingles = set()
+    remaining = SOURCE_TOKEN_BUDGET
+    for result in sorted(results, key=lambda result: result.score, reverse=True):
+        if remaining <= 0:
+            break
+        tokens = TOKENIZER.encode_ordinary(result.text)[:min(SOURCE_TOKEN_LIMIT, remaining)]
+        if not tokens:
+            continue
+        shingles = {tuple(tokens[i:i + 5]) for i in range(max(len(tokens) - 4, 1))}
+        if len(shingles & seen_shingles) > SOURCE_OVERLAP_LIMIT * len(shingles):
+            continue
+        seen_shingles |= shingles
+        remaining -= len(tokens)
+        selected.append(result._replace(text=TOKENIZER.decode(tokens)))
+    return selected
+
+# A student is waiting on these calls, so back off briefly and give up sooner than the
+# upload scripts do. OpenAI calls are retried by the SDK itself (max_retries).
+pinecone_retry = retry(
+    wait=wait_random_exponential(multiplier=0.5, max=4),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(is_retryable_pinecone_error),
+    reraise=True
+)
+
+@pinecone_retry
+def search_with_retry(index, namespace: str, query: dict, fields: list):
+    """Search with integrated embedding, backing off only when Pinecone pushes back"""
+    return index.search(namespace=namespace, query=query, fields=fields)
+
+@pinecone_retry
+def fetch_with_retry(index, namespace: str, ids: list):
+    """Fetch records by id, backing off only when Pinecone pushes back"""
+    return index.fetch(namespace=namespace, ids=ids)
 
 def initialize_pinecone():
     """Initialize Pinecone client separately"""
@@ -27,85 +231,333 @@ def initialize_pinecone():
         import pinecone
         # Use the newer Pinecone class pattern
         pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
-        print("✅ Pinecone client initialized successfully")
+        logger.info("✅ Pinecone client initialized successfully")
         return pc
     except Exception as e:
-        print(f"❌ Failed to initialize Pinecone: {e}")
+        logger.error("❌ Failed to initialize Pinecone: %s", e)
         raise e
 
+async def read_json_object(stream, on_delta=None) -> str:
+    """Collect a streamed completion up to the end of its first top-level JSON object
+    
+    Tracks brace depth (ignoring braces inside strings) so the stream can be closed as
+    soon as the object is complete instead of waiting for any trailing text. Each piece
+    of text is also passed to on_delta, if given, as it arrives.
+    """
+    parts = []
+    depth = 0
+    started = in_string = escaped = False
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        parts.append(delta)
+        if on_delta:
+            on_delta(delta)
+        for position, char in enumerate(delta):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = started
+            elif char == '{':
+                depth += 1
+                started = True
+            elif char == '}' and started:
+                depth -= 1
+                if depth == 0:
+                    await stream.response.aclose()
+                    parts[-1] = delta[:position + 1]
+                    return "".join(parts)
+    return "".join(parts)
+
 class RAGGradingSystem:
     def __init__(self):
         try:
             # Initialize clients separately
             self.pc = initialize_pinecone()
-            self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+            # Only used on event_loop. One pooled HTTP client keeps connections alive across
+            # requests, so bursts of grading calls don't each pay a TCP/TLS handshake
+            self.openai_client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                max_retries=5,  # Backs off on 429/5xx, honouring Retry-After
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                    timeout=60.0
+                )
+            )
+            self.model_tier = GRADING_MODEL_TIER if GRADING_MODEL_TIER in ("tiered", "fast", "full") else "tiered"
             self.index_name = "aiprofessors"
-            print("✅ RAG Grading System initialized successfully")
+            self.index = self.pc.Index(self.index_name)  # One handle, so connections are pooled across requests
+            # The rubric is static between uploads, so it is fetched once and reused
+            self.rubric_cache_ttl = float(os.environ.get('RUBRIC_CACHE_TTL', 600))  # seconds
+            self._rubric_cache = {}  # top_n -> (fetched_at, rubric chunks)
+            self._rubric_lock = threading.Lock()
+            # Graded results for repeated submissions, keyed on the normalized (question, answer)
+            self.grade_cache_size = int(os.environ.get('GRADE_CACHE_SIZE', 512))
+            self._grade_cache = OrderedDict()  # blake2b key -> result dict, in LRU order
+            self._grade_cache_lock = threading.Lock()
+            # Textbook search results per (normalized question, top_k); a class's answers to the
+            # same question all need the same sources
+            self.search_cache_size = int(os.environ.get('SEARCH_CACHE_SIZE', 512))
+            self._search_cache = OrderedDict()  # (query, top_k) -> formatted results, in LRU order
+            self._search_cache_lock = threading.Lock()
+            self._search_inflight = {}  # (query, top_k) -> Future of a search already under way
+            # Tokens in the prompt prefix shared by every grade; updated when the rubric is fetched
+            self.static_prompt_tokens = GRADING_SYSTEM_PROMPT_TOKENS
+            logger.info("✅ RAG Grading System initialized successfully")
         except Exception as e:
-            print(f"❌ Failed to initialize RAG system: {e}")
-            print(f"❌ Error type: {type(e).__name__}")
-            import traceback
-            print(f"❌ Full traceback: {traceback.format_exc()}")
+            # The caller logs the traceback
+            logger.error("❌ Failed to initialize RAG system: %s", e)
             raise e
     
     def search_with_existing_index(self, query: str, top_k: int = 8) -> list:
+        """Search using the existing index, answering repeated questions from memory
+        
+        When a class submits at once, the first request for a question runs the search (and
+        Pinecone's query embedding) and concurrent requests for it wait on that result.
+        """
+        key = (' '.join(query.lower().split()), top_k)
+        with self._search_cache_lock:
+            if key in self._search_cache:
+                self._search_cache.move_to_end(key)
+                return list(self._search_cache[key])
+            inflight = self._search_inflight.get(key)
+            if inflight is None:
+                self._search_inflight[key] = Future()
+        if inflight is not None:
+            return list(inflight.result())
+        
+        formatted_results = []
+        try:
+            formatted_results = self._search_with_existing_index(query, top_k)
+        finally:
+            with self._search_cache_lock:
+                # Empty results usually mean the search failed; don't pin them
+                if formatted_results:
+                    self._search_cache[key] = tuple(formatted_results)
+                    while len(self._search_cache) > self.search_cache_size:
+                        self._search_cache.popitem(last=False)
+                self._search_inflight.pop(key).set_result(tuple(formatted_results))
+        return formatted_results
+    
+    def _search_with_existing_index(self, query: str, top_k: int = 8) -> list:
         """Search using the existing index with hosted embedding model"""
         try:
-            index = self.pc.Index(self.index_name)
+            index = self.index
             
             # Search with hosted embedding model
-            results = index.search(
+            results = search_with_retry(
+                index,
                 namespace="textbook",
                 query={
                     "inputs": {"text": query},
                     "top_k": top_k
-                }
+                },
+                fields=["text"]  # The only field grading reads; skip any other stored fields
             )
             
-            # Format results
-            formatted_results = []
-            if results and hasattr(results, 'result') and hasattr(results.result, 'hits'):
-                for hit in results.result.hits:
-                    formatted_results.append({
-                        'score': hit._score,
-                        'text': hit.fields.get('text', '') if hit.fields else '',
-                        'metadata': {'id': hit._id}
-                    })
+            try:
+                hits = results.result.hits
+            except AttributeError:
+                return []
             
-            return formatted_results
+            # Format results, then keep only as much text as goes into the grading prompt
+            return select_sources([Hit(hit._score, (hit.fields or {}).get('text', ''), hit._id) for hit in hits])
             
         except Exception as e:
-            print(f"❌ Search failed: {e}")
+            logger.warning("❌ Search failed: %s", e)
             return []
     
     def fetch_top_rubric_chunks(self, top_n: int = 3) -> list:
         """Fetch the top N rubric chunks by ID"""
         try:
-            index = self.pc.Index(self.index_name)
+            chunk_ids = [f"rubric_chunk_{i}" for i in range(top_n)]
+            
+            # fetch takes a list of ids, so all chunks come back in one round-trip
+            res = fetch_with_retry(self.index, namespace="textbook", ids=chunk_ids)
+            vectors = getattr(res, 'vectors', None) or {}
+            
+            # Walk the requested ids rather than the response dict to keep chunk order
             rubric_chunks = []
-            for i in range(top_n):
-                chunk_id = f"rubric_chunk_{i}"
-                res = index.fetch(namespace="textbook", ids=[chunk_id])
-                if res and hasattr(res, 'vectors') and chunk_id in res.vectors:
-                    text = res.vectors[chunk_id].fields.get('text', '') if hasattr(res.vectors[chunk_id], 'fields') else ''
-                    if text:
-                        rubric_chunks.append({
-                            'id': chunk_id,
-                            'text': text
-                        })
+            for chunk_id in chunk_ids:
+                vector = vectors.get(chunk_id)
+                fields = getattr(vector, 'fields', None) or {}
+                # Trim once here; the cached chunks are then used as-is by every prompt
+                text = fields.get('text', '')[:RUBRIC_CHAR_LIMIT]
+                if text:
+                    rubric_chunks.append({
+                        'id': chunk_id,
+                        'text': text
+                    })
             return rubric_chunks
         except Exception as e:
-            print(f"❌ Failed to fetch rubric chunks: {e}")
+            logger.warning("❌ Failed to fetch rubric chunks: %s", e)
             return []
     
-    def grade_student_answer(self, question: str, student_answer: str) -> dict:
-        """Grade a student answer using RAG"""
+    def get_rubric_chunks(self, top_n: int = 3) -> list:
+        """Return the top N rubric chunks, refetching only when the cached copy has expired"""
+        cached = self._rubric_cache.get(top_n)
+        if cached and time.monotonic() - cached[0] < self.rubric_cache_ttl:
+            return cached[1]
+        with self._rubric_lock:
+            # Another request may have refreshed the cache while we waited
+            cached = self._rubric_cache.get(top_n)
+            if cached and time.monotonic() - cached[0] < self.rubric_cache_ttl:
+                return cached[1]
+            rubric_chunks = self.fetch_top_rubric_chunks(top_n)
+            if rubric_chunks:  # Don't pin a failed or empty fetch
+                self._rubric_cache[top_n] = (time.monotonic(), rubric_chunks)
+                # Token counts only change with the rubric, so count them here, not per request
+                self.static_prompt_tokens = GRADING_SYSTEM_PROMPT_TOKENS + sum(
+                    len(TOKENIZER.encode_ordinary(chunk['text'])) for chunk in rubric_chunks
+                )
+            return rubric_chunks
+    
+    @staticmethod
+    def grade_cache_key(question: str, student_answer: str) -> bytes:
+        """Cache key that ignores case and whitespace differences, but nothing else"""
+        normalized = ' '.join(question.lower().split()) + '\x00' + ' '.join(student_answer.lower().split())
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+    
+    async def retrieve_context(self, question: str) -> tuple:
+        """Return (textbook search results, rubric chunks) for a question"""
+        # The textbook search and the rubric fetch (usually cached) are independent
+        # blocking Pinecone calls, so they run side by side on worker threads
+        search_results, rubric_chunks = await asyncio.gather(
+            asyncio.to_thread(self.search_with_existing_index, question, 8),
+            asyncio.to_thread(self.get_rubric_chunks, 3)
+        )
+        return search_results, rubric_chunks
+    
+    async def grade_one(self, question: str, student_answer: str, on_delta=None) -> dict:
+        """Retrieve context for a question and grade one answer against it"""
+        search_results, rubric_chunks = await self.retrieve_context(question)
+        return await self.grade_with_context(question, student_answer, search_results, rubric_chunks, on_delta)
+    
+    def cached_grade(self, key: bytes):
+        """Return a copy of the cached grade for key, or None"""
+        with self._grade_cache_lock:
+            if key in self._grade_cache:
+                self._grade_cache.move_to_end(key)
+                return dict(self._grade_cache[key])
+        return None
+    
+    def store_grade(self, key: bytes, result: dict):
+        """Cache a grade; errors are not cached, so a transient failure is retried next time"""
+        if 'error' in result:
+            return
+        with self._grade_cache_lock:
+            self._grade_cache[key] = dict(result)
+            while len(self._grade_cache) > self.grade_cache_size:
+                self._grade_cache.popitem(last=False)
+    
+    @staticmethod
+    def validate_submission(question: str, student_answer: str):
+        """Return an error message for input not worth a search and a completion, else None"""
+        question = question.strip()
+        student_answer = student_answer.strip()
+        if len(question) < MIN_QUESTION_CHARS or not any(char.isalpha() for char in question):
+            return "Question is too short to grade against"
+        if not any(char.isalnum() for char in student_answer):
+            return "Student answer is empty"
+        if len(question) > MAX_INPUT_CHARS or len(student_answer) > MAX_INPUT_CHARS:
+            return f"Question and student answer must each be under {MAX_INPUT_CHARS} characters"
+        return None
+    
+    @staticmethod
+    def precheck_submission(question: str, student_answer: str):
+        """Return the response for a submission that needs no search or completion, else None"""
+        invalid = RAGGradingSystem.validate_submission(question, student_answer)
+        if invalid:
+            return {"error": invalid}
+        if len(student_answer.strip()) < MIN_ANSWER_CHARS:
+            return {
+                "grade": "F",
+                "score": 0,
+                "feedback": "The answer is too short to demonstrate any understanding of the question.",
+                "strengths": [],
+                "weaknesses": ["Answer is too short"],
+                "key_points_missing": [],
+                "key_points_correct": [],
+                "confidence": "high",
+                "suggestions": ["Write a complete answer that addresses the question"],
+                "rubric_applied": "None; the answer was too short to grade against the rubric"
+            }
+        return None
+    
+    def grade_student_answer(self, question: str, student_answer: str, on_delta=None) -> dict:
+        """Grade a student answer using RAG, reusing the grade of an identical earlier submission
+        
+        If on_delta is given it is called with each piece of the model's JSON as it streams
+        in, and with None when a low-confidence grade is discarded to re-grade on the full model.
+        """
+        # Answer degenerate input before any Pinecone or OpenAI round-trip
+        prechecked = self.precheck_submission(question, student_answer)
+        if prechecked:
+            return prechecked
+        
+        key = self.grade_cache_key(question, student_answer)
+        cached = self.cached_grade(key)
+        if cached is not None:
+            return cached
+        
         try:
-            # Search for relevant textbook content
-            search_results = self.search_with_existing_index(question, top_k=8)
-            # Fetch rubric chunks
-            rubric_chunks = self.fetch_top_rubric_chunks(top_n=3)
+            result = run_async(self.grade_one(question, student_answer, on_delta))
+        except Exception as e:
+            result = {"error": f"Grading failed: {e}"}
+        
+        self.store_grade(key, result)
+        return result
+    
+    def grade_batch(self, submissions: list) -> list:
+        """Grade many (question, student_answer) pairs, searching once per distinct question"""
+        keys = [self.grade_cache_key(question, student_answer) for question, student_answer in submissions]
+        results = []
+        for (question, student_answer), key in zip(submissions, keys):
+            results.append(self.precheck_submission(question, student_answer) or self.cached_grade(key))
+        # Identical submissions in one batch (same normalized question and answer) are graded once
+        first_by_key = {}
+        for i, result in enumerate(results):
+            if result is None:
+                first_by_key.setdefault(keys[i], i)
+        pending = list(first_by_key.values())
+        if not pending:
+            return results
+        
+        async def grade_pending():
+            # A class answering the same question shares one textbook search and one rubric
+            # fetch; all of them run concurrently
+            questions = list(dict.fromkeys(submissions[i][0] for i in pending))
+            rubric_chunks, *searches = await asyncio.gather(
+                asyncio.to_thread(self.get_rubric_chunks, 3),
+                *(asyncio.to_thread(self.search_with_existing_index, question, 8) for question in questions)
+            )
+            search_results = dict(zip(questions, searches))
             
+            # Grading calls are independent, so they all go out together
+            return await asyncio.gather(*(
+                self.grade_with_context(
+                    submissions[i][0], submissions[i][1], search_results[submissions[i][0]], rubric_chunks
+                )
+                for i in pending
+            ))
+        
+        for i, result in zip(pending, run_async(grade_pending())):
+            self.store_grade(keys[i], result)
+            results[i] = result
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = dict(results[first_by_key[keys[i]]])
+        return results
+    
+    async def grade_with_context(self, question: str, student_answer: str, search_results: list, rubric_chunks: list, on_delta=None) -> dict:
+        """Grade a student answer against already-retrieved textbook and rubric context"""
+        try:
             if not search_results and not rubric_chunks:
                 return {
                     "error": "No relevant content found",
@@ -114,103 +566,86 @@ class RAGGradingSystem:
                     "feedback": "Could not find relevant information to grade this answer."
                 }
             
-            # Prepare context from search results
-            context_parts = []
-            for i, result in enumerate(search_results):
-                text = result['text'][:1000]  # Limit context per result
-                context_parts.append(f"Source {i+1} (Relevance: {result['score']:.3f}): {text}")
-            
-            context = "\n\n".join(context_parts)
+            # Prepare context from search results, joined in one pass
+            context = "\n\n".join(
+                f"Source {i+1}: {result.text}"
+                for i, result in enumerate(search_results)
+            )
             
             # Prepare rubric context
-            rubric_parts = []
-            for i, chunk in enumerate(rubric_chunks):
-                rubric_parts.append(f"Rubric {i+1}: {chunk['text'][:1000]}")
-            rubric_context = "\n\n".join(rubric_parts)
+            rubric_context = "\n\n".join(
+                f"Rubric {i+1}: {chunk['text']}"
+                for i, chunk in enumerate(rubric_chunks)
+            )
             
             # Create grading prompt
-            prompt = f"""
-You are an expert educator grading a student's answer to a business ethics question. Use the provided sources to evaluate the student's response.
-
-QUESTION: "{question}"
-STUDENT ANSWER: "{student_answer}"
-
-TEXTBOOK SOURCES:
-{context}
-
-RUBRIC CRITERIA:
-{rubric_context}
-
-Please grade this answer based on:
-1. **Accuracy of content** - does it match the textbook material?
-2. **Completeness of response** - does it cover key points from the rubric?
-3. **Clarity and organization** - is the answer well-structured?
-4. **Use of relevant examples or concepts** - does it demonstrate understanding?
-5. **Adherence to grading criteria** - does it meet the rubric standards?
-
-Return your evaluation in JSON format:
-{{
-    "grade": "A/B/C/D/F",
-    "score": 85,
-    "feedback": "Detailed feedback explaining the grade",
-    "strengths": ["strength 1", "strength 2"],
-    "weaknesses": ["weakness 1", "weakness 2"],
-    "key_points_missing": ["missing point 1", "missing point 2"],
-    "key_points_correct": ["correct point 1", "correct point 2"],
-    "confidence": "high/medium/low",
-    "suggestions": ["suggestion 1", "suggestion 2"],
-    "rubric_applied": "Brief note on which rubric criteria were used"
-}}
-
-Be fair but rigorous. A grade of A should be for excellent answers, B for good, C for satisfactory, D for poor, and F for failing.
-"""
-
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert educator who grades student answers using both textbook content and grading rubrics."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2,
-                max_tokens=2000
+            prompt = GRADING_PROMPT_TEMPLATE.format(
+                rubric_context=rubric_context,
+                question=question,
+                context=context,
+                student_answer=student_answer
             )
+
+            messages = [
+                {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
             
-            content = response.choices[0].message.content
-            try:
-                if '{' in content and '}' in content:
-                    start = content.find('{')
-                    end = content.rfind('}') + 1
-                    json_str = content[start:end]
-                    return json.loads(json_str)
-                else:
-                    return {"error": "No valid JSON found in response", "raw_response": content}
-            except json.JSONDecodeError as e:
-                return {"error": f"JSON parsing failed: {e}", "raw_response": content}
+            # Most answers are graded fine by the small model; only unparseable or
+            # low-confidence grades are re-run on the full model
+            if self.model_tier == "full":
+                return await self.request_grade(messages, FULL_GRADING_MODEL, 2000, on_delta)
+            result = await self.request_grade(messages, FAST_GRADING_MODEL, 800, on_delta)
+            if self.model_tier == "tiered" and ('error' in result or result.get('confidence') == 'low'):
+                if on_delta:
+                    on_delta(None)
+                result = await self.request_grade(messages, FULL_GRADING_MODEL, 2000, on_delta)
+            return result
                 
         except Exception as e:
             return {"error": f"Grading failed: {e}"}
 
+    async def request_grade(self, messages: list, model: str, max_tokens: int, on_delta=None) -> dict:
+        """Run one grading completion and parse the grade object out of it"""
+        # The slot is held until the stream is read, since that is when the tokens are generated
+        async with openai_semaphore:
+            response = await self.openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=max_tokens,
+                response_format=GRADE_RESPONSE_FORMAT,  # Output is always a well-formed grade object
+                stream=True
+            )
+            
+            # Stop reading as soon as the grade object is complete
+            content = await read_json_object(response, on_delta)
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError as e:
+            # Only reachable if the completion was cut off at max_tokens
+            return {"error": f"JSON parsing failed: {e}", "raw_response": content}
+
 # Initialize grading system
 grading_system = None
 if PINECONE_API_KEY and OPENAI_API_KEY:
     try:
-        print("🔧 Attempting to initialize RAGGradingSystem...")
+        logger.info("🔧 Attempting to initialize RAGGradingSystem...")
         grading_system = RAGGradingSystem()
-        print("✅ RAG Grading System initialized successfully")
-    except Exception as e:
-        print(f"❌ Failed to initialize RAG system: {e}")
-        print(f"❌ Error type: {type(e).__name__}")
-        import traceback
-        print(f"❌ Full traceback: {traceback.format_exc()}")
+        # Warm the rubric cache in the background so the first /grade doesn't pay for the
+        # fetch, without holding up start-up
+        io_executor.submit(grading_system.get_rubric_chunks, 3)
+    except Exception:
+        logger.exception("❌ Failed to initialize RAG system")
         grading_system = None
 else:
-    print("⚠️ Warning: Missing API keys. Grading functionality will be limited.")
-    print(f"PINECONE_API_KEY: {'Set' if PINECONE_API_KEY else 'Missing'}")
-    print(f"OPENAI_API_KEY: {'Set' if OPENAI_API_KEY else 'Missing'}")
+    logger.warning("⚠️ Warning: Missing API keys. Grading functionality will be limited.")
+    logger.warning("PINECONE_API_KEY: %s", 'Set' if PINECONE_API_KEY else 'Missing')
+    logger.warning("OPENAI_API_KEY: %s", 'Set' if OPENAI_API_KEY else 'Missing')
     if PINECONE_API_KEY:
-        print(f"PINECONE_API_KEY length: {len(PINECONE_API_KEY)}")
+        logger.warning("PINECONE_API_KEY length: %d", len(PINECONE_API_KEY))
     if OPENAI_API_KEY:
-        print(f"OPENAI_API_KEY length: {len(OPENAI_API_KEY)}")
+        logger.warning("OPENAI_API_KEY length: %d", len(OPENAI_API_KEY))
 
 # Simple health check
 @app.route('/health')
@@ -240,7 +675,9 @@ def debug():
         "openai_key_length": len(OPENAI_API_KEY) if OPENAI_API_KEY else 0,
         "pinecone_key_start": PINECONE_API_KEY[:10] + "..." if PINECONE_API_KEY else "None",
         "openai_key_start": OPENAI_API_KEY[:10] + "..." if OPENAI_API_KEY else "None",
-        "grading_system_initialized": grading_system is not None
+        "grading_system_initialized": grading_system is not None,
+        "static_prompt_tokens": grading_system.static_prompt_tokens if grading_system else GRADING_SYSTEM_PROMPT_TOKENS,
+        "prompt_cache_eligible": (grading_system.static_prompt_tokens if grading_system else GRADING_SYSTEM_PROMPT_TOKENS) >= PROMPT_CACHE_MIN_TOKENS
     })
 
 # Test initialization endpoint
@@ -334,193 +771,105 @@ def grade():
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"})
 
-# Main page
+# Streaming grading endpoint
+@app.route('/grade_stream', methods=['POST'])
+def grade_stream():
+    """Grade a student answer, streaming the model's output as Server-Sent Events
+    
+    Emits "delta" events with raw JSON text as the model writes it, "reset" if that text is
+    discarded for a re-grade, and a final "result" event with the same object /grade returns.
+    """
+    try:
+        if not grading_system:
+            return jsonify({"error": "Grading system not initialized. Please check API keys."})
+        
+        data = request.get_json() or {}
+        question = data.get('question', '')
+        student_answer = data.get('student_answer', '')
+        
+        if not question or not student_answer:
+            return jsonify({"error": "Question and student answer are required"})
+        
+        return stream_deltas(io_executor, grading_system.grade_student_answer, question, student_answer)
+        
+    except Exception as e:
+        return jsonify({"error": f"Server error: {str(e)}"})
+
+# Batch grading endpoint
+MAX_BATCH_SIZE = 100
+
+@app.route('/grade_batch', methods=['POST'])
+@app.route('/grade-batch', methods=['POST'])
+def grade_batch():
+    """Grade several student answers in one request
+    
+    Accepts {"submissions": [{"question": ..., "student_answer": ...}, ...]} ("items" is
+    accepted as an alias); a top-level "question" applies to every submission that
+    doesn't set its own.
+    """
+    try:
+        if not grading_system:
+            return jsonify({"error": "Grading system not initialized. Please check API keys."})
+        
+        data = request.get_json() or {}
+        default_question = data.get('question', '')
+        submissions = data.get('submissions', data.get('items', []))
+        
+        if not isinstance(submissions, list) or not submissions:
+            return jsonify({"error": "A non-empty list of submissions is required"})
+        if len(submissions) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} submissions per batch"})
+        
+        # Grade the valid submissions together and slot per-item errors in around them
+        results = [None] * len(submissions)
+        pairs = []
+        positions = []
+        for i, submission in enumerate(submissions):
+            question = submission.get('question', default_question) if isinstance(submission, dict) else ''
+            student_answer = submission.get('student_answer', '') if isinstance(submission, dict) else ''
+            if not question or not student_answer:
+                results[i] = {"error": "Question and student answer are required"}
+            else:
+                pairs.append((question, student_answer))
+                positions.append(i)
+        
+        for i, result in zip(positions, grading_system.grade_batch(pairs)):
+            results[i] = result
+        return jsonify({"results": results})
+        
+    except Exception as e:
+        return jsonify({"error": f"Server error: {str(e)}"})
+
+# Main page; the HTML is fully static, so it is read and compressed once at import
+with open(os.path.join(app.static_folder, 'index.html'), 'rb') as file:
+    INDEX_HTML = file.read()
+INDEX_HTML_GZIP = gzip.compress(INDEX_HTML, compresslevel=9, mtime=0)  # Compressed once, not per request
+
 @app.route('/')
 def index():
     """Main page"""
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>RAG Grading System</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 40px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }
-            .container { max-width: 800px; margin: 0 auto; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
-            .header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; }
-            .header h1 { font-size: 2.5em; margin-bottom: 10px; }
-            .header p { font-size: 1.1em; opacity: 0.9; }
-            .content { padding: 40px; }
-            .form-group { margin-bottom: 25px; }
-            label { display: block; margin-bottom: 8px; font-weight: 600; color: #333; }
-            input, textarea { width: 100%; padding: 12px; border: 2px solid #e1e5e9; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
-            textarea { resize: vertical; min-height: 120px; }
-            input:focus, textarea:focus { outline: none; border-color: #667eea; }
-            button { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 15px 30px; border: none; border-radius: 8px; font-size: 16px; font-weight: 600; cursor: pointer; transition: transform 0.2s ease; }
-            button:hover { transform: translateY(-2px); }
-            button:disabled { opacity: 0.6; cursor: not-allowed; transform: none; }
-            .result { margin-top: 30px; padding: 25px; border-radius: 10px; background: #f8f9fa; border-left: 5px solid #667eea; }
-            .grade { font-size: 3em; font-weight: bold; text-align: center; margin-bottom: 15px; }
-            .grade.A { color: #28a745; }
-            .grade.B { color: #17a2b8; }
-            .grade.C { color: #ffc107; }
-            .grade.D { color: #fd7e14; }
-            .grade.F { color: #dc3545; }
-            .score { text-align: center; font-size: 1.5em; font-weight: 600; margin-bottom: 20px; }
-            .feedback { background: white; padding: 20px; border-radius: 8px; margin-bottom: 20px; }
-            .feedback h3 { margin-bottom: 15px; color: #333; }
-            .strengths, .weaknesses, .missing, .correct, .suggestions { margin-bottom: 15px; }
-            .strengths h4 { color: #28a745; }
-            .weaknesses h4 { color: #dc3545; }
-            .missing h4 { color: #fd7e14; }
-            .correct h4 { color: #17a2b8; }
-            .suggestions h4 { color: #6f42c1; }
-            .rubric h4 { color: #20c997; }
-            ul { margin-left: 20px; }
-            li { margin-bottom: 5px; }
-            .loading { text-align: center; padding: 40px; color: #666; }
-            .error { background: #f8d7da; color: #721c24; padding: 15px; border-radius: 8px; border: 1px solid #f5c6cb; }
-            .confidence { text-align: center; font-size: 1.1em; margin-bottom: 15px; padding: 10px; border-radius: 5px; }
-            .confidence.high { background: #d4edda; color: #155724; }
-            .confidence.medium { background: #fff3cd; color: #856404; }
-            .confidence.low { background: #f8d7da; color: #721c24; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>🎓 RAG Grading System</h1>
-                <p>AI-Powered Student Answer Evaluation with Textbook & Rubric Context</p>
-            </div>
-            
-            <div class="content">
-                <form id="gradingForm">
-                    <div class="form-group">
-                        <label for="question">Question:</label>
-                        <input type="text" id="question" placeholder="Enter the question here..." required>
-                    </div>
-                    <div class="form-group">
-                        <label for="studentAnswer">Student Answer:</label>
-                        <textarea id="studentAnswer" placeholder="Enter the student's answer here..." required></textarea>
-                    </div>
-                    <button type="submit" id="gradeBtn">Grade Answer</button>
-                </form>
-                
-                <div id="result" class="result" style="display: none;"></div>
-            </div>
-        </div>
-        
-        <script>
-            document.getElementById('gradingForm').addEventListener('submit', async function(event) {
-                event.preventDefault();
-                
-                const question = document.getElementById('question').value;
-                const studentAnswer = document.getElementById('studentAnswer').value;
-                const resultDiv = document.getElementById('result');
-                const gradeBtn = document.getElementById('gradeBtn');
-                
-                resultDiv.style.display = 'block';
-                resultDiv.innerHTML = '<div class="loading">🤔 Analyzing answer...</div>';
-                gradeBtn.disabled = true;
-                gradeBtn.textContent = 'Grading...';
-                
-                try {
-                    const response = await fetch('/grade', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({ question: question, student_answer: studentAnswer })
-                    });
-                    
-                    const result = await response.json();
-                    
-                    if (result.error) {
-                        resultDiv.innerHTML = `<div class="error">❌ Error: ${result.error}</div>`;
-                    } else {
-                        const grade = result.grade || 'N/A';
-                        const score = result.score || 0;
-                        const feedback = result.feedback || 'No feedback available';
-                        const confidence = result.confidence || 'unknown';
-                        
-                        let html = `
-                            <div class="grade ${grade}">${grade}</div>
-                            <div class="score">Score: ${score}/100</div>
-                            <div class="confidence ${confidence}">Confidence: ${confidence.toUpperCase()}</div>
-                            
-                            <div class="feedback">
-                                <h3>📝 Feedback</h3>
-                                <p>${feedback}</p>
-                            </div>
-                        `;
-                        
-                        if (result.strengths && result.strengths.length > 0) {
-                            html += `
-                                <div class="strengths">
-                                    <h4>✅ Strengths</h4>
-                                    <ul>${result.strengths.map(s => `<li>${s}</li>`).join('')}</ul>
-                                </div>
-                            `;
-                        }
-                        
-                        if (result.weaknesses && result.weaknesses.length > 0) {
-                            html += `
-                                <div class="weaknesses">
-                                    <h4>❌ Areas for Improvement</h4>
-                                    <ul>${result.weaknesses.map(w => `<li>${w}</li>`).join('')}</ul>
-                                </div>
-                            `;
-                        }
-                        
-                        if (result.key_points_correct && result.key_points_correct.length > 0) {
-                            html += `
-                                <div class="correct">
-                                    <h4>🎯 Correct Points</h4>
-                                    <ul>${result.key_points_correct.map(p => `<li>${p}</li>`).join('')}</ul>
-                                </div>
-                            `;
-                        }
-                        
-                        if (result.key_points_missing && result.key_points_missing.length > 0) {
-                            html += `
-                                <div class="missing">
-                                    <h4>⚠️ Missing Points</h4>
-                                    <ul>${result.key_points_missing.map(p => `<li>${p}</li>`).join('')}</ul>
-                                </div>
-                            `;
-                        }
-                        
-                        if (result.suggestions && result.suggestions.length > 0) {
-                            html += `
-                                <div class="suggestions">
-                                    <h4>💡 Suggestions</h4>
-                                    <ul>${result.suggestions.map(s => `<li>${s}</li>`).join('')}</ul>
-                                </div>
-                            `;
-                        }
-                        
-                        if (result.rubric_applied) {
-                            html += `
-                                <div class="rubric">
-                                    <h4>📋 Rubric Applied</h4>
-                                    <p>${result.rubric_applied}</p>
-                                </div>
-                            `;
-                        }
-                        
-                        resultDiv.innerHTML = html;
-                    }
-                    
-                } catch (error) {
-                    resultDiv.innerHTML = `<div class="error">❌ Error: ${error.message}</div>`;
-                } finally {
-                    gradeBtn.disabled = false;
-                    gradeBtn.textContent = 'Grade Answer';
-                }
-            });
-        </script>
-    </body>
-    </html>
-    """
+    headers = {'Cache-Control': 'public, max-age=3600', 'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(INDEX_HTML_GZIP, mimetype='text/html', headers=headers)
+    return Response(INDEX_HTML, mimetype='text/html', headers=headers)
+
+# Grading results carry several KB of feedback text; compress JSON replies for clients that accept it
+GZIP_MIN_SIZE = 500  # bytes; smaller bodies aren't worth the CPU
+
+@app.after_request
+def compress_json(response):
+    """Gzip JSON responses when the client accepts it"""
+    if (response.mimetype == 'application/json'
+            and 'Content-Encoding' not in response.headers
+            and not response.direct_passthrough
+            and 'gzip' in request.accept_encodings):
+        body = response.get_data()
+        if len(body) >= GZIP_MIN_SIZE:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+    return response
 
 # Error handlers
 @app.errorhandler(500)
@@ -535,4 +884,5 @@ def not_found(error):
 if __name__ == '__main__':
     print("🚀 Starting RAG Grading UI...")
     print("📱 Open your browser to: http://localhost:5002")
-    app.run(debug=True, host='0.0.0.0', port=5002) 
\ No newline at end of file
+    # Development server only; use gunicorn for anything else (see DEPLOYMENT.md)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5002, threaded=True) 
\ No newline at end of file
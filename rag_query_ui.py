@@ -5,10 +5,19 @@ Simple web interface for querying the RAG system
 """
 
 import os
-import json
-from flask import Flask, render_template_string, request, jsonify
+import re
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, request, jsonify, send_from_directory
+import httpx
+import orjson
+import tiktoken
 from pinecone import Pinecone
-from openai import OpenAI
+from sse import stream_deltas
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -22,16 +31,163 @@ if not PINECONE_API_KEY or not OPENAI_API_KEY:
     print("❌ Error: Please set PINECONE_API_KEY and OPENAI_API_KEY environment variables")
     exit(1)
 
+# Queries run on one long-lived event loop in a background thread, so Flask stays a plain
+# WSGI app while both namespace searches and the answer completion share one client
+event_loop = asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, name="openai-event-loop", daemon=True).start()
+
+def run_async(coro):
+    """Run a coroutine on the background event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 600))  # seconds
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 2000))
+
+def normalize_question(question: str) -> str:
+    """Lowercase and collapse whitespace so trivially different phrasings share a cache entry"""
+    return ' '.join(question.lower().split())
+
+class QueryCache:
+    """Thread-safe LRU cache whose entries expire after a fixed TTL"""
+    
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, value), in LRU order
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entries over max_size"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> dict:
+        """Size and hit/miss counts since start-up"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+FAST_ANSWER_MODEL = "gpt-4o-mini"
+FULL_ANSWER_MODEL = "gpt-4o"
+ESCALATION_MIN_QUESTION_CHARS = 100  # Low-confidence answers to longer questions get the full model
+ANSWER_MAX_TOKENS = 400  # Answers are 2-3 sentences plus a few key points
+
+SOURCE_TOKEN_LIMIT = 200  # Max tokens of each search hit that reach the answer prompt
+SOURCE_TOKEN_BUDGET = 1600  # Max tokens of source context per answer prompt
+SOURCE_OVERLAP_LIMIT = 0.3  # Skip a hit if this share of its 5-token shingles is already in the prompt
+TOKENIZER = tiktoken.encoding_for_model("gpt-4o-mini")
+
+def trim_sources(search_results: list) -> list:
+    """Cut each hit to SOURCE_TOKEN_LIMIT tokens, stopping once SOURCE_TOKEN_BUDGET is spent
+    
+    Neighbouring chunks of the same section often come back together; a hit is skipped
+    when most of its 5-token shingles were already kept, so the budget goes to distinct
+    material. Returns (result, text) pairs in the original (best-first) order.
+    """
+    trimmed = []
+    seen_shingles = set()
+    remaining = SOURCE_TOKEN_BUDGET
+    for result in search_results:
+        if remaining <= 0:
+            break
+        tokens = TOKENIZER.encode_ordinary(result['text'])[:min(SOURCE_TOKEN_LIMIT, remaining)]
+        if not tokens:
+            continue
+        shingles = {tuple(tokens[i:i + 5]) for i in range(max(len(tokens) - 4, 1))}
+        if len(shingles & seen_shingles) > SOURCE_OVERLAP_LIMIT * len(shingles):
+            continue
+        seen_shingles |= shingles
+        remaining -= len(tokens)
+        trimmed.append((result, TOKENIZER.decode(tokens)))
+    return trimmed
+
+# Structured Outputs schema for answers: the model can only emit these fields. answer
+# comes first so the page can show it while the rest streams in.
+ANSWER_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "rag_answer",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "answer": {"type": "string"},
+                "confidence": {"type": "string", "enum": ["high", "medium", "low"]},
+                "key_points": {"type": "array", "items": {"type": "string"}},
+                "sources_used": {"type": "integer"},
+                "quality_score": {"type": "number"}
+            },
+            "required": ["answer", "confidence", "key_points", "sources_used", "quality_score"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Best-hit scores closer than this count as a tie, broken by the syllabus keyword check
+NAMESPACE_TIE_MARGIN = 0.02
+
 class RAGQuerySystem:
     def __init__(self):
         self.pc = Pinecone(api_key=PINECONE_API_KEY)
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        # Only used on event_loop. One pooled HTTP client keeps connections alive across
+        # requests, so each answer doesn't pay a TCP/TLS handshake
+        self.openai_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                timeout=60.0
+            )
+        )
         self.index_name = "aiprofessors"
+        self.index = self.pc.Index(self.index_name)  # One handle, so connections are pooled across requests
+        # Search hits per (namespace, question) and final answers per question
+        self.search_cache = QueryCache()
+        self.answer_cache = QueryCache()
+        # Answers currently being computed, so concurrent identical questions share one
+        self._inflight = {}  # answer cache key -> Future of (result, namespace, scores)
+        self._inflight_lock = threading.Lock()
         
     def search_with_existing_index(self, query: str, top_k: int = 8, namespace: str = "textbook") -> list:
+        """Search using the existing index, answering repeated questions from memory"""
+        key = (namespace, normalize_question(query), top_k)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return [dict(result) for result in cached]
+        
+        formatted_results = self._search_with_existing_index(query, top_k, namespace)
+        if formatted_results:  # Empty results usually mean the search failed; don't pin them
+            self.search_cache.put(key, [dict(result) for result in formatted_results])
+        return formatted_results
+    
+    def _search_with_existing_index(self, query: str, top_k: int = 8, namespace: str = "textbook") -> list:
         """Search using the existing index with hosted embedding model"""
         try:
-            index = self.pc.Index(self.index_name)
+            index = self.index
             
             # Search with hosted embedding model
             results = index.search(
@@ -58,12 +214,72 @@ class RAGQuerySystem:
             print(f"❌ Search failed: {e}")
             return []
     
-    def query_rag(self, question: str, namespace: str = "textbook") -> dict:
-        """Query RAG system for an answer"""
-        try:
-            # Search for relevant content
-            search_results = self.search_with_existing_index(question, top_k=8, namespace=namespace)
+    def query_best_namespace(self, question: str, prefer_syllabus: bool = False, on_delta=None) -> tuple:
+        """Answer from whichever namespace matches the question best
+        
+        Both namespaces are searched concurrently (cheap), but only the one with the best
+        hit is sent to OpenAI. prefer_syllabus breaks near-ties. Returns (result,
+        namespace_used, syllabus_score, textbook_score); repeated questions are answered
+        from the cache, and concurrent identical questions wait on the first one's answer
+        rather than running their own searches and completion. on_delta, if given,
+        receives the answer text as it streams in, and None when that text is discarded
+        (to escalate to the full model or try the other namespace).
+        """
+        key = (normalize_question(question), prefer_syllabus)
+        cached = self.answer_cache.get(key)
+        if cached is not None:
+            result, namespace, syllabus_score, textbook_score = cached
+            return dict(result), namespace, syllabus_score, textbook_score
+        
+        with self._inflight_lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                self._inflight[key] = Future()
+        if inflight is not None:
+            result, namespace, syllabus_score, textbook_score = inflight.result()
+            return dict(result), namespace, syllabus_score, textbook_score
+        
+        async def search_then_answer():
+            syllabus_results, textbook_results = await asyncio.gather(
+                asyncio.to_thread(self.search_with_existing_index, question, 8, "syllabus"),
+                asyncio.to_thread(self.search_with_existing_index, question, 8, "textbook")
+            )
+            syllabus_score = syllabus_results[0]['score'] if syllabus_results else 0
+            textbook_score = textbook_results[0]['score'] if textbook_results else 0
             
+            if abs(syllabus_score - textbook_score) <= NAMESPACE_TIE_MARGIN and syllabus_results and textbook_results:
+                use_syllabus = prefer_syllabus
+            else:
+                use_syllabus = syllabus_score > textbook_score
+            ranked = [("syllabus", syllabus_results), ("textbook", textbook_results)]
+            if not use_syllabus:
+                ranked.reverse()
+            
+            # Fall back to the other namespace only if the winner produced no answer
+            for attempt, (namespace, search_results) in enumerate(ranked):
+                if attempt and on_delta:
+                    on_delta(None)
+                result = await self.synthesize_answer(question, search_results, on_delta)
+                if result.get('answer') and 'error' not in result:
+                    break
+            return result, namespace, syllabus_score, textbook_score
+        
+        try:
+            result, namespace, syllabus_score, textbook_score = run_async(search_then_answer())
+        except Exception as e:
+            with self._inflight_lock:
+                self._inflight.pop(key).set_exception(e)
+            raise
+        
+        if 'error' not in result:  # Let failed answers be retried
+            self.answer_cache.put(key, (dict(result), namespace, syllabus_score, textbook_score))
+        with self._inflight_lock:
+            self._inflight.pop(key).set_result((dict(result), namespace, syllabus_score, textbook_score))
+        return result, namespace, syllabus_score, textbook_score
+    
+    async def synthesize_answer(self, question: str, search_results: list, on_delta=None) -> dict:
+        """Answer a question from already-retrieved search results, streaming the completion"""
+        try:
             if not search_results:
                 return {
                     "error": "No relevant content found",
@@ -71,12 +287,10 @@ class RAGQuerySystem:
                 }
             
             # Prepare context from search results
-            context_parts = []
-            for i, result in enumerate(search_results):
-                text = result['text'][:800]  # Limit context per result
-                context_parts.append(f"Source {i+1} (Relevance: {result['score']:.3f}): {text}")
-            
-            context = "\n\n".join(context_parts)
+            context = "\n\n".join(
+                f"Source {i+1} (Relevance: {result['score']:.3f}): {text}"
+                for i, (result, text) in enumerate(trim_sources(search_results))
+            )
             
             # Create answer synthesis prompt
             prompt = f"""
@@ -101,422 +315,109 @@ Guidelines for concise answers:
 - Keep each sentence focused and clear
 - Avoid lengthy explanations unless specifically requested
 
-Return your answer in JSON format:
-{{
-    "answer": "your precise and concise answer here (2-3 sentences max)",
-    "confidence": "high/medium/low",
-    "key_points": ["essential point 1", "essential point 2"],
-    "sources_used": number_of_sources,
-    "quality_score": 0.85,
-    "search_stats": {{
-        "total_sources": number_of_sources,
-        "best_score": highest_relevance_score,
-        "average_score": average_relevance_score
-    }}
-}}
+In the answer field give your answer in 2-3 sentences; rate quality_score from 0 to 1.
 """
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert educator who provides precise, concise answers. Focus on clarity and brevity while maintaining accuracy. Give direct answers in 2-3 sentences maximum."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2,
-                max_tokens=1000
-            )
+            messages = [
+                {"role": "system", "content": "You are an expert educator who provides precise, concise answers. Focus on clarity and brevity while maintaining accuracy. Give direct answers in 2-3 sentences maximum."},
+                {"role": "user", "content": prompt}
+            ]
+            
+            # The small model handles short answers from retrieved context well; only long
+            # questions it is unsure about are re-run on the full model
+            result = await self.request_answer(messages, FAST_ANSWER_MODEL, on_delta)
+            if 'error' not in result and result.get('confidence') == 'low' and len(question) > ESCALATION_MIN_QUESTION_CHARS:
+                if on_delta:
+                    on_delta(None)
+                result = await self.request_answer(messages, FULL_ANSWER_MODEL, on_delta)
+            if 'error' in result:
+                return result
             
-            content = response.choices[0].message.content
-            try:
-                if '{' in content and '}' in content:
-                    start = content.find('{')
-                    end = content.rfind('}') + 1
-                    json_str = content[start:end]
-                    result = json.loads(json_str)
-                    
-                    # Add search statistics
-                    if search_results:
-                        result['search_stats'] = {
-                            'total_sources': len(search_results),
-                            'best_score': search_results[0]['score'],
-                            'average_score': sum(r['score'] for r in search_results) / len(search_results)
-                        }
-                    
-                    return result
-                else:
-                    return {"error": "No valid JSON found in response", "raw_response": content}
-            except json.JSONDecodeError as e:
-                return {"error": f"JSON parsing failed: {e}", "raw_response": content}
+            # Add search statistics
+            result['search_stats'] = {
+                'total_sources': len(search_results),
+                'best_score': search_results[0]['score'],
+                'average_score': sum(r['score'] for r in search_results) / len(search_results)
+            }
+            
+            return result
                 
         except Exception as e:
             return {"error": f"Query failed: {e}"}
+    
+    async def request_answer(self, messages: list, model: str, on_delta=None) -> dict:
+        """Run one answer completion, streaming it to on_delta, and parse the answer object"""
+        response = await self.openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=ANSWER_MAX_TOKENS,
+            response_format=ANSWER_RESPONSE_FORMAT,  # Output is always a well-formed answer object
+            stream=True
+        )
+        
+        # Collect the streamed completion, passing each piece on as it arrives
+        parts = []
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                if on_delta:
+                    on_delta(delta)
+        content = "".join(parts)
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError as e:
+            # Only reachable if the completion was cut off at max_tokens
+            return {"error": f"JSON parsing failed: {e}", "raw_response": content}
 
 # Initialize the query system
 query_system = RAGQuerySystem()
 
+# Runs streamed queries while the response generator relays their output
+stream_executor = ThreadPoolExecutor(max_workers=16)
+
 # Flask app
 app = Flask(__name__)
 
-# HTML template
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>RAG Query System</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            background: white;
-            border-radius: 15px;
-            box-shadow: 0 20px 40px rgba(0,0,0,0.1);
-            overflow: hidden;
-        }
-        
-        .header {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 30px;
-            text-align: center;
-        }
-        
-        .header h1 {
-            font-size: 2.5em;
-            margin-bottom: 10px;
-        }
-        
-        .header p {
-            font-size: 1.1em;
-            opacity: 0.9;
-        }
-        
-        .content {
-            padding: 40px;
-        }
-        
-        .form-group {
-            margin-bottom: 25px;
-        }
-        
-        label {
-            display: block;
-            margin-bottom: 8px;
-            font-weight: 600;
-            color: #333;
-        }
-        
-        input[type="text"], textarea {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #e1e5e9;
-            border-radius: 8px;
-            font-size: 16px;
-            transition: border-color 0.3s ease;
-        }
-        
-        input[type="text"]:focus, textarea:focus {
-            outline: none;
-            border-color: #667eea;
-        }
-        
-        textarea {
-            resize: vertical;
-            min-height: 120px;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 15px 30px;
-            border: none;
-            border-radius: 8px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: transform 0.2s ease;
-        }
-        
-        .btn:hover {
-            transform: translateY(-2px);
-        }
-        
-        .btn:disabled {
-            opacity: 0.6;
-            cursor: not-allowed;
-            transform: none;
-        }
-        
-        .result {
-            margin-top: 30px;
-            padding: 25px;
-            border-radius: 10px;
-            background: #f8f9fa;
-            border-left: 5px solid #667eea;
-        }
-        
-        .answer {
-            background: white;
-            padding: 20px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-            line-height: 1.6;
-        }
-        
-        .answer h3 {
-            margin-bottom: 15px;
-            color: #333;
-        }
-        
-        .stats {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-            gap: 15px;
-            margin-bottom: 20px;
-        }
-        
-        .stat-card {
-            background: white;
-            padding: 15px;
-            border-radius: 8px;
-            text-align: center;
-            border: 1px solid #e1e5e9;
-        }
-        
-        .stat-card h4 {
-            color: #667eea;
-            margin-bottom: 5px;
-        }
-        
-        .stat-card .value {
-            font-size: 1.5em;
-            font-weight: bold;
-            color: #333;
-        }
-        
-        .key-points {
-            background: white;
-            padding: 20px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-        }
-        
-        .key-points h4 {
-            color: #28a745;
-            margin-bottom: 15px;
-        }
-        
-        ul {
-            margin-left: 20px;
-        }
-        
-        li {
-            margin-bottom: 8px;
-            line-height: 1.4;
-        }
-        
-        .loading {
-            text-align: center;
-            padding: 40px;
-            color: #666;
-        }
-        
-        .error {
-            background: #f8d7da;
-            color: #721c24;
-            padding: 15px;
-            border-radius: 8px;
-            border: 1px solid #f5c6cb;
-        }
-        
-        .confidence {
-            display: inline-block;
-            padding: 5px 15px;
-            border-radius: 20px;
-            font-weight: 600;
-            margin-bottom: 15px;
-        }
-        
-        .confidence.high { background: #d4edda; color: #155724; }
-        .confidence.medium { background: #fff3cd; color: #856404; }
-        .confidence.low { background: #f8d7da; color: #721c24; }
-        
-        .sample-queries {
-            margin-top: 30px;
-            padding: 20px;
-            background: #f8f9fa;
-            border-radius: 8px;
-        }
-        
-        .sample-queries h3 {
-            margin-bottom: 15px;
-            color: #333;
-        }
-        
-        .sample-btn {
-            background: #6c757d;
-            color: white;
-            padding: 8px 15px;
-            border: none;
-            border-radius: 5px;
-            margin: 5px;
-            cursor: pointer;
-            font-size: 14px;
-        }
-        
-        .sample-btn:hover {
-            background: #5a6268;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>🔍 RAG Query System</h1>
-            <p>Ask questions about Business Ethics</p>
-        </div>
-        
-        <div class="content">
-            <form id="queryForm">
-                <div class="form-group">
-                    <label for="question">Your Question:</label>
-                    <input type="text" id="question" name="question" placeholder="Ask any question about business ethics..." required>
-                </div>
-                
-                <button type="submit" class="btn" id="queryBtn">Get Answer</button>
-            </form>
-            
-            <div id="result" style="display: none;"></div>
-            
-            <div class="sample-queries">
-                <h3>💡 Sample Questions:</h3>
-                <h4>📚 Textbook Questions:</h4>
-                <button class="sample-btn" onclick="setQuestion('What is utilitarianism?')">What is utilitarianism?</button>
-                <button class="sample-btn" onclick="setQuestion('Explain the difference between honesty and fidelity')">Honesty vs Fidelity</button>
-                <button class="sample-btn" onclick="setQuestion('What is business ethics?')">What is business ethics?</button>
-                <button class="sample-btn" onclick="setQuestion('How does corporate social responsibility work?')">Corporate Social Responsibility</button>
-                <button class="sample-btn" onclick="setQuestion('What are the main ethical theories in business?')">Ethical Theories</button>
-                
-                <h4>📋 Syllabus Questions:</h4>
-                <button class="sample-btn" onclick="setQuestion('What is the grading policy?')">Grading Policy</button>
-                <button class="sample-btn" onclick="setQuestion('What are the course objectives?')">Course Objectives</button>
-                <button class="sample-btn" onclick="setQuestion('What are the required materials?')">Required Materials</button>
-                <button class="sample-btn" onclick="setQuestion('What is the attendance policy?')">Attendance Policy</button>
-                <button class="sample-btn" onclick="setQuestion('What are the late work policies?')">Late Work Policies</button>
-            </div>
-        </div>
-    </div>
-    
-    <script>
-        function setQuestion(question) {
-            document.getElementById('question').value = question;
-        }
-        
-        document.getElementById('queryForm').addEventListener('submit', async function(e) {
-            e.preventDefault();
-            
-            const question = document.getElementById('question').value;
-            const queryBtn = document.getElementById('queryBtn');
-            const resultDiv = document.getElementById('result');
-            
-            // Show loading
-            queryBtn.disabled = true;
-            queryBtn.textContent = 'Searching...';
-            resultDiv.style.display = 'block';
-            resultDiv.innerHTML = '<div class="loading">🔍 Searching for relevant information...</div>';
-            
-            try {
-                const response = await fetch('/query', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        question: question
-                    })
-                });
-                
-                const result = await response.json();
-                
-                if (result.error) {
-                    resultDiv.innerHTML = `<div class="error">❌ Error: ${result.error}</div>`;
-                } else {
-                    const answer = result.answer || 'No answer available';
-                    const confidence = result.confidence || 'unknown';
-                    const qualityScore = result.quality_score || 'N/A';
-                    const sourcesUsed = result.sources_used || 'N/A';
-                    const keyPoints = result.key_points || [];
-                    const searchStats = result.search_stats || {};
-                    
-                    let html = `
-                        <div class="result">
-                            <div class="answer">
-                                <h3>📝 Answer</h3>
-                                <p>${answer}</p>
-                            </div>
-                            
-                            <div class="stats">
-                                <div class="stat-card">
-                                    <h4>Confidence</h4>
-                                    <div class="value confidence ${confidence}">${confidence.toUpperCase()}</div>
-                                </div>
-                                <div class="stat-card">
-                                    <h4>Quality Score</h4>
-                                    <div class="value">${qualityScore}</div>
-                                </div>
-                                <div class="stat-card">
-                                    <h4>Sources Used</h4>
-                                    <div class="value">${sourcesUsed}</div>
-                                </div>
-                                <div class="stat-card">
-                                    <h4>Best Match Score</h4>
-                                    <div class="value">${searchStats.best_score ? searchStats.best_score.toFixed(3) : 'N/A'}</div>
-                                </div>
-                            </div>
-                    `;
-                    
-                    if (keyPoints.length > 0) {
-                        html += `
-                            <div class="key-points">
-                                <h4>🔑 Key Points</h4>
-                                <ul>${keyPoints.map(point => `<li>${point}</li>`).join('')}</ul>
-                            </div>
-                        `;
-                    }
-                    
-                    html += '</div>';
-                    resultDiv.innerHTML = html;
-                }
-                
-            } catch (error) {
-                resultDiv.innerHTML = `<div class="error">❌ Error: ${error.message}</div>`;
-            } finally {
-                queryBtn.disabled = false;
-                queryBtn.textContent = 'Get Answer';
-            }
-        });
-    </script>
-</body>
-</html>
-"""
-
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # Flask serves the file with sendfile, and handles ETag / If-Modified-Since revalidation
+    return send_from_directory(app.static_folder, 'query.html', max_age=3600)
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit/miss counts for the search and answer caches"""
+    return jsonify({
+        "search": query_system.search_cache.stats(),
+        "answer": query_system.answer_cache.stats()
+    })
+
+# Words that suggest a question is about the course rather than the textbook material
+SYLLABUS_KEYWORDS = [
+    'grading', 'policy', 'attendance', 'late', 'makeup', 'exam', 'assignment',
+    'syllabus', 'course', 'objective', 'material', 'textbook', 'schedule',
+    'office hour', 'contact', 'outline', 'module', 'unit', 'week', 'final',
+    'midterm', 'participation', 'discussion', 'board', 'academic', 'integrity'
+]
+# One alternation scans the question once instead of once per keyword; like the substring
+# checks it replaces, keywords match anywhere, including inside longer words
+SYLLABUS_KEYWORD_RE = re.compile('|'.join(map(re.escape, SYLLABUS_KEYWORDS)), re.IGNORECASE)
+
+def answer_question(question: str, on_delta=None) -> dict:
+    """Answer a question from the namespace that matches it best"""
+    # Determine namespace based on question content
+    is_syllabus_query = SYLLABUS_KEYWORD_RE.search(question) is not None
+    
+    # Search both namespaces, but only synthesize an answer from the better one
+    result, namespace_used, syllabus_score, textbook_score = query_system.query_best_namespace(
+        question, prefer_syllabus=is_syllabus_query, on_delta=on_delta
+    )
+    other_namespace, other_score = ('textbook', textbook_score) if namespace_used == 'syllabus' else ('syllabus', syllabus_score)
+    used_score = syllabus_score if namespace_used == 'syllabus' else textbook_score
+    result['namespace_used'] = namespace_used
+    result['score_comparison'] = f'{namespace_used}: {used_score:.3f} vs {other_namespace}: {other_score:.3f}'
+    return result
 
 @app.route('/query', methods=['POST'])
 def query():
@@ -527,39 +428,26 @@ def query():
         if not question:
             return jsonify({"error": "Question is required"})
         
-        # Determine namespace based on question content
-        syllabus_keywords = [
-            'grading', 'policy', 'attendance', 'late', 'makeup', 'exam', 'assignment',
-            'syllabus', 'course', 'objective', 'material', 'textbook', 'schedule',
-            'office hour', 'contact', 'outline', 'module', 'unit', 'week', 'final',
-            'midterm', 'participation', 'discussion', 'board', 'academic', 'integrity'
-        ]
-        
-        question_lower = question.lower()
-        is_syllabus_query = any(keyword in question_lower for keyword in syllabus_keywords)
-        
-        # Always try both namespaces and use the best result
-        syllabus_result = query_system.query_rag(question, namespace="syllabus")
-        textbook_result = query_system.query_rag(question, namespace="textbook")
+        return jsonify(answer_question(question))
         
-        # Compare results and use the better one
-        syllabus_score = syllabus_result.get('search_stats', {}).get('best_score', 0) if syllabus_result.get('search_stats') else 0
-        textbook_score = textbook_result.get('search_stats', {}).get('best_score', 0) if textbook_result.get('search_stats') else 0
+    except Exception as e:
+        return jsonify({"error": f"Server error: {str(e)}"})
+
+@app.route('/query_stream', methods=['POST'])
+def query_stream():
+    """Answer a question, streaming the model's output as Server-Sent Events
+    
+    Emits "delta" events with raw completion text as the model writes it, "reset" if that
+    text is discarded, and a final "result" event with the same object /query returns.
+    """
+    try:
+        data = request.get_json() or {}
+        question = data.get('question', '')
         
-        if syllabus_score > textbook_score and syllabus_result.get('answer'):
-            result = syllabus_result
-            result['namespace_used'] = 'syllabus'
-            result['score_comparison'] = f'syllabus: {syllabus_score:.3f} vs textbook: {textbook_score:.3f}'
-        elif textbook_result.get('answer'):
-            result = textbook_result
-            result['namespace_used'] = 'textbook'
-            result['score_comparison'] = f'textbook: {textbook_score:.3f} vs syllabus: {syllabus_score:.3f}'
-        else:
-            # Fallback to whichever has any result
-            result = syllabus_result if syllabus_result.get('answer') else textbook_result
-            result['namespace_used'] = 'syllabus' if syllabus_result.get('answer') else 'textbook'
+        if not question:
+            return jsonify({"error": "Question is required"})
         
-        return jsonify(result)
+        return stream_deltas(stream_executor, answer_question, question)
         
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"})
@@ -568,4 +456,5 @@ if __name__ == '__main__':
     print("🚀 Starting RAG Query UI...")
     print("📱 Open your browser to: http://localhost:5003")
     print("🔍 Ready to answer questions!")
-    app.run(host='0.0.0.0', port=5003, debug=True) 
\ No newline at end of file
+    # Development server only; use gunicorn for anything else (see DEPLOYMENT.md)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5003, threaded=True)
\ No newline at end of file
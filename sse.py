@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Server-Sent Events Helpers
+Relays a streamed model completion to the browser for the grading and query UIs
+"""
+
+import queue
+from concurrent.futures import Executor
+from flask import Response, stream_with_context
+import orjson
+
+def sse_event(event: str, data) -> bytes:
+    """Format one Server-Sent Events frame with a JSON payload"""
+    return b"event: " + event.encode('utf-8') + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+def stream_deltas(executor: Executor, work, *args) -> Response:
+    """Run work(*args, on_delta) on executor and relay its progress as Server-Sent Events
+    
+    work calls on_delta with each piece of model output ("delta" events) and with None
+    when that output is discarded ("reset"); its return value becomes a final "result" event.
+    """
+    # Deltas arrive on the event loop thread; a queue hands them to this response
+    events = queue.Queue()
+    
+    def on_delta(text):
+        events.put(("delta", text) if text is not None else ("reset", None))
+    
+    future = executor.submit(work, *args, on_delta)
+    future.add_done_callback(lambda _: events.put(None))
+    
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            yield sse_event(*item)
+        try:
+            yield sse_event("result", future.result())
+        except Exception as e:
+            yield sse_event("result", {"error": f"Server error: {str(e)}"})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
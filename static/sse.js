@@ -0,0 +1,35 @@
+// Reads a Server-Sent Events response from stream_deltas() (see sse.py). onPartial is
+// called with all model output received so far; resolves with the final result object.
+async function readDeltaStream(response, onPartial) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let partial = '';
+    let result = { error: 'Stream ended unexpectedly' };
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let eventName = 'message';
+            let data = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            const payload = data ? JSON.parse(data) : null;
+            if (eventName === 'delta') {
+                partial += payload;
+                onPartial(partial);
+            } else if (eventName === 'reset') {
+                partial = '';
+            } else if (eventName === 'result') {
+                result = payload;
+            }
+        }
+    }
+    return result;
+}
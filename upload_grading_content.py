@@ -4,31 +4,60 @@ Upload Grading Content to Dedicated Grading Index
 Uploads rubrics, grading criteria, and other grading materials
 """
 
+import io
 import os
 import re
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import PyPDF2
 from pinecone import Pinecone
+from pinecone_retry import upsert_records_with_retry
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Common rubric section headers, combined so each line is scanned once
+RUBRIC_SECTION_RE = re.compile('|'.join([
+        r'GRADING\s+CRITERIA',
+        r'RUBRIC',
+        r'SCORING\s+GUIDE',
+        r'EVALUATION\s+CRITERIA',
+        r'ASSESSMENT\s+STANDARDS',
+        r'POINTS?\s*:?\s*\d+',
+        r'SCORE\s*:?\s*\d+',
+        r'GRADE\s*:?\s*[A-F]',
+        r'EXCELLENT\s*\([^)]+\)',
+        r'GOOD\s*\([^)]+\)',
+        r'FAIR\s*\([^)]+\)',
+        r'POOR\s*\([^)]+\)',
+        r'CRITERIA\s+\d+',
+        r'QUESTION\s+\d+',
+        r'PART\s+[A-Z]',
+        r'[A-Z]\s*\.\s*[A-Z]',  # A. B. C. etc.
+    ]), re.IGNORECASE)
+SENTENCE_SPLIT_RE = re.compile(r'[.!?]+')
+
 class GradingContentUploader:
     def __init__(self):
         self.pc = Pinecone(api_key=os.environ.get('PINECONE_API_KEY'))
         self.index_name = "aiprofessorgrading"
+        self.max_workers = 8
+        self.manifest_path = "rubric_hashes.json"  # chunk id -> content hash of the last upload
         
     def extract_rubric_text(self, file_path: str) -> str:
         """Extract text from PDF rubric"""
         try:
+            # Parse from memory rather than seeking around the file handle
             with open(file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text()
-                
-                print(f"✅ Extracted {len(text)} characters from rubric")
-                return text
+                reader = PyPDF2.PdfReader(io.BytesIO(file.read()))
+            text = ""
+            for page in reader.pages:
+                text += page.extract_text()
+            
+            print(f"✅ Extracted {len(text)} characters from rubric")
+            return text
                 
         except Exception as e:
             print(f"❌ Failed to extract text from {file_path}: {e}")
@@ -38,26 +67,6 @@ class GradingContentUploader:
         """Create semantic chunks from rubric text"""
         chunks = []
         
-        # Split by sections (common rubric patterns)
-        section_patterns = [
-            r'GRADING\s+CRITERIA',
-            r'RUBRIC',
-            r'SCORING\s+GUIDE',
-            r'EVALUATION\s+CRITERIA',
-            r'ASSESSMENT\s+STANDARDS',
-            r'POINTS?\s*:?\s*\d+',
-            r'SCORE\s*:?\s*\d+',
-            r'GRADE\s*:?\s*[A-F]',
-            r'EXCELLENT\s*\([^)]+\)',
-            r'GOOD\s*\([^)]+\)',
-            r'FAIR\s*\([^)]+\)',
-            r'POOR\s*\([^)]+\)',
-            r'CRITERIA\s+\d+',
-            r'QUESTION\s+\d+',
-            r'PART\s+[A-Z]',
-            r'[A-Z]\s*\.\s*[A-Z]',  # A. B. C. etc.
-        ]
-        
         # Find sections
         sections = []
         current_section = ""
@@ -69,7 +78,7 @@ class GradingContentUploader:
                 continue
                 
             # Check if this line starts a new section
-            is_section_header = any(re.search(pattern, line, re.IGNORECASE) for pattern in section_patterns)
+            is_section_header = RUBRIC_SECTION_RE.search(line) is not None
             
             if is_section_header and current_section:
                 sections.append(current_section.strip())
@@ -94,7 +103,7 @@ class GradingContentUploader:
             # Split large sections into smaller chunks
             if len(section) > 1000:
                 # Split by sentences
-                sentences = re.split(r'[.!?]+', section)
+                sentences = SENTENCE_SPLIT_RE.split(section)
                 current_chunk = ""
                 
                 for sentence in sentences:
@@ -126,28 +135,66 @@ class GradingContentUploader:
         print(f"✅ Created {len(chunks)} rubric chunks")
         return chunks
     
-    def upload_rubric_chunks(self, chunks: list) -> bool:
+    def load_manifest(self) -> dict:
+        """Load the content hashes recorded by the previous upload"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+    
+    def save_manifest(self, manifest: dict):
+        """Persist content hashes so unchanged chunks are skipped next time"""
+        with open(self.manifest_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+    
+    def upload_rubric_chunks(self, chunks: list, force: bool = False) -> bool:
         """Upload rubric chunks to grading index"""
         try:
             index = self.pc.Index(self.index_name)
+            manifest = {} if force else self.load_manifest()
             
-            # Prepare records for upload
+            # Prepare records for upload, skipping chunks Pinecone has already embedded
             records = []
+            hashes = {}
             for chunk in chunks:
+                # PDF extraction leaves runs of spaces; collapsing them shrinks the stored
+                # text field and the upsert payload without changing what gets embedded
+                text = ' '.join(chunk["text"].split())
+                content_hash = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+                hashes[chunk["id"]] = content_hash
+                if manifest.get(chunk["id"]) == content_hash:
+                    continue
                 records.append({
                     "id": chunk["id"],
-                    "text": chunk["text"]
+                    "text": text
                 })
             
-            # Upload in batches
-            batch_size = 50
-            for i in range(0, len(records), batch_size):
-                batch = records[i:i + batch_size]
-                index.upsert_records(
-                    namespace="textbook",
-                    records=batch
-                )
-                print(f"📤 Uploaded batch {i//batch_size + 1}/{(len(records) + batch_size - 1)//batch_size}")
+            if not records:
+                print("✅ Rubric unchanged since last upload, nothing to do")
+                return True
+            print(f"📋 {len(records)}/{len(chunks)} rubric chunks are new or changed")
+            
+            # Upload in batches (96 is the upsert_records limit for integrated indexes,
+            # so a typical rubric goes up in a single request)
+            batch_size = 96
+            # Group similar-length chunks so each embedding batch is evenly sized; ids travel
+            # with the records, so upload order doesn't matter
+            records.sort(key=lambda record: len(record["text"]))
+            batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+            
+            # Send batches concurrently; larger rubric imports keep several requests in flight
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(upsert_records_with_retry, index, "textbook", batch)
+                    for batch in batches
+                ]
+                for n, future in enumerate(as_completed(futures), start=1):
+                    future.result()
+                    print(f"📤 Uploaded batch {n}/{len(batches)}")
+            
+            manifest.update(hashes)
+            self.save_manifest(manifest)
             
             print(f"✅ Successfully uploaded {len(records)} rubric chunks!")
             return True
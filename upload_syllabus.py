@@ -4,12 +4,14 @@ Upload Syllabus to RAG System
 Uploads syllabus content to the existing Pinecone index
 """
 
+import io
 import os
 import json
-import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any
 from pinecone import Pinecone
+from pinecone_retry import upsert_records_with_retry
 from openai import OpenAI
 from dotenv import load_dotenv
 
@@ -24,11 +26,46 @@ if not PINECONE_API_KEY or not OPENAI_API_KEY:
     print("❌ Error: Please set PINECONE_API_KEY and OPENAI_API_KEY environment variables")
     exit(1)
 
+# Common syllabus section headers
+SECTION_PATTERNS = [
+    r'COURSE\s+DESCRIPTION',
+    r'LEARNING\s+OBJECTIVES',
+    r'COURSE\s+OBJECTIVES',
+    r'REQUIRED\s+MATERIALS',
+    r'TEXTBOOKS',
+    r'GRADING\s+POLICY',
+    r'ASSIGNMENTS',
+    r'EXAMS',
+    r'COURSE\s+SCHEDULE',
+    r'WEEKLY\s+SCHEDULE',
+    r'WEEK\s+\d+',  # Add week patterns like "Week 9"
+    r'FINAL\s+EXAM',
+    r'MIDTERM\s+EXAM',
+    r'FIRST\s+EXAM',
+    r'POLICIES',
+    r'ACADEMIC\s+INTEGRITY',
+    r'ATTENDANCE',
+    r'LATE\s+WORK',
+    r'MAKEUP\s+EXAMS',
+    r'OFFICE\s+HOURS',
+    r'CONTACT\s+INFORMATION',
+    r'COURSE\s+OUTLINE',
+    r'TOPICS',
+    r'MODULES',
+    r'UNITS'
+]
+# Zero-width lookahead over all headers: one scan of the text yields every position where
+# any header starts, already in order and without duplicates
+SECTION_BOUNDARY_RE = re.compile('(?=' + '|'.join(f'(?:{pattern})' for pattern in SECTION_PATTERNS) + ')', re.IGNORECASE)
+SENTENCE_SPLIT_RE = re.compile(r'[.!?]+')
+WEEK_LINE_RE = re.compile(r'Week\s+\d+', re.IGNORECASE)
+
 class SyllabusUploader:
     def __init__(self):
         self.pc = Pinecone(api_key=PINECONE_API_KEY)
         self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
         self.index_name = "aiprofessors"
+        self.max_workers = 8  # Upsert requests in flight at once
         
     def extract_syllabus_text(self, file_path: str) -> str:
         """Extract text from syllabus file (PDF or TXT)"""
@@ -36,10 +73,11 @@ class SyllabusUploader:
             if file_path.lower().endswith('.pdf'):
                 import PyPDF2
                 text = ""
+                # Parse from memory rather than seeking around the file handle
                 with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page in pdf_reader.pages:
-                        text += page.extract_text() + "\n"
+                    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.read()))
+                for page in pdf_reader.pages:
+                    text += page.extract_text() + "\n"
                 return text
             elif file_path.lower().endswith('.txt'):
                 with open(file_path, 'r', encoding='utf-8') as file:
@@ -53,52 +91,14 @@ class SyllabusUploader:
     
     def create_syllabus_chunks(self, text: str) -> List[Dict[str, Any]]:
         """Create semantic chunks optimized for syllabus content"""
-        import re
-        
         # Clean text
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = ' '.join(text.split())  # str.split() is a C-level whitespace scan, no regex engine
         
         # Split into sections based on common syllabus patterns
         sections = []
         
-        # Common syllabus section headers
-        section_patterns = [
-            r'COURSE\s+DESCRIPTION',
-            r'LEARNING\s+OBJECTIVES',
-            r'COURSE\s+OBJECTIVES',
-            r'REQUIRED\s+MATERIALS',
-            r'TEXTBOOKS',
-            r'GRADING\s+POLICY',
-            r'ASSIGNMENTS',
-            r'EXAMS',
-            r'COURSE\s+SCHEDULE',
-            r'WEEKLY\s+SCHEDULE',
-            r'WEEK\s+\d+',  # Add week patterns like "Week 9"
-            r'FINAL\s+EXAM',
-            r'MIDTERM\s+EXAM',
-            r'FIRST\s+EXAM',
-            r'POLICIES',
-            r'ACADEMIC\s+INTEGRITY',
-            r'ATTENDANCE',
-            r'LATE\s+WORK',
-            r'MAKEUP\s+EXAMS',
-            r'OFFICE\s+HOURS',
-            r'CONTACT\s+INFORMATION',
-            r'COURSE\s+OUTLINE',
-            r'TOPICS',
-            r'MODULES',
-            r'UNITS'
-        ]
-        
         # Find section boundaries
-        section_boundaries = []
-        for pattern in section_patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                section_boundaries.append(match.start())
-        
-        # Sort boundaries
-        section_boundaries.sort()
+        section_boundaries = [match.start() for match in SECTION_BOUNDARY_RE.finditer(text)]
         
         # Create sections
         if section_boundaries:
@@ -121,7 +121,7 @@ class SyllabusUploader:
                     continue
                     
                 # Check if this is a week line
-                if re.match(r'Week\s+\d+', line, re.IGNORECASE):
+                if WEEK_LINE_RE.match(line):
                     if current_section:
                         other_sections.append(current_section)
                     current_section = line
@@ -154,7 +154,7 @@ class SyllabusUploader:
             # If section is too long, split it
             if len(section) > 1000:
                 # Split by sentences for long sections
-                sentences = re.split(r'[.!?]+', section)
+                sentences = SENTENCE_SPLIT_RE.split(section)
                 sentences = [s.strip() for s in sentences if s.strip()]
                 
                 current_chunk = ""
@@ -162,22 +162,24 @@ class SyllabusUploader:
                     if len(current_chunk) + len(sentence) < 1200:  # Increased chunk size
                         current_chunk += sentence + ". "
                     else:
-                        if current_chunk.strip():
+                        chunk_text = current_chunk.strip()
+                        if chunk_text:
                             chunks.append({
                                 'id': f"syllabus_chunk_{chunk_id}",
-                                'text': current_chunk.strip(),
-                                'length': len(current_chunk.strip()),
+                                'text': chunk_text,
+                                'length': len(chunk_text),
                                 'type': 'syllabus_section'
                             })
                             chunk_id += 1
                         current_chunk = sentence + ". "
                 
                 # Add the last chunk
-                if current_chunk.strip():
+                chunk_text = current_chunk.strip()
+                if chunk_text:
                     chunks.append({
                         'id': f"syllabus_chunk_{chunk_id}",
-                        'text': current_chunk.strip(),
-                        'length': len(current_chunk.strip()),
+                        'text': chunk_text,
+                        'length': len(chunk_text),
                         'type': 'syllabus_section'
                     })
                     chunk_id += 1
@@ -198,29 +200,43 @@ class SyllabusUploader:
         try:
             index = self.pc.Index(self.index_name)
             
-            # Prepare data for the existing index
-            records = []
-            for i, chunk in enumerate(chunks):
-                records.append({
-                    "id": f"syllabus_chunk_{i}",
-                    "text": chunk['text']
-                })
+            # Keep ids and texts as parallel lists; record dicts are only built per batch,
+            # right before it is sent
+            texts = [chunk['text'] for chunk in chunks]
+            ids = [f"syllabus_chunk_{i}" for i in range(len(texts))]
             
             # Upload in batches
             batch_size = 50  # Reduced batch size for stability
-            total_chunks = len(records)
+            total_chunks = len(texts)
             
-            for i in range(0, total_chunks, batch_size):
-                batch = records[i:i + batch_size]
-                
-                # Upsert to existing index
-                index.upsert_records(
-                    namespace="syllabus",  # Use syllabus namespace
-                    records=batch
-                )
-                
-                print(f"📤 Uploaded batch {i//batch_size + 1}/{(total_chunks + batch_size - 1)//batch_size}")
-                time.sleep(1)  # Rate limiting
+            batch_starts = range(0, total_chunks, batch_size)
+            total_batches = len(batch_starts)
+            
+            def batch_records(start: int) -> List[Dict[str, str]]:
+                return [
+                    {"id": chunk_id, "text": text}
+                    for chunk_id, text in zip(ids[start:start + batch_size], texts[start:start + batch_size])
+                ]
+            
+            # Batches are independent, so send them concurrently and note any that fail
+            failed_batches = []
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {
+                    executor.submit(upsert_records_with_retry, index, "syllabus", batch_records(start)): n  # Use syllabus namespace
+                    for n, start in enumerate(batch_starts, start=1)
+                }
+                for future in as_completed(futures):
+                    n = futures[future]
+                    try:
+                        future.result()
+                        print(f"📤 Uploaded batch {n}/{total_batches}")
+                    except Exception as e:
+                        failed_batches.append(n)
+                        print(f"❌ Batch {n}/{total_batches} failed: {e}")
+            
+            if failed_batches:
+                print(f"❌ Failed batches (re-run to retry): {sorted(failed_batches)}")
+                return False
             
             print(f"✅ Successfully uploaded {total_chunks} syllabus chunks!")
             return True